@@ -0,0 +1,211 @@
+"""
+SQLite index of skysub results for fast queries across nights and exposures
+"""
+
+import os, re, glob
+import json
+import sqlite3
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fiber_stats (
+    night INTEGER NOT NULL,
+    expid INTEGER NOT NULL,
+    camera TEXT NOT NULL,
+    nsky INTEGER NOT NULL,
+    rep INTEGER NOT NULL,
+    fiber INTEGER,
+    rms REAL,
+    integrated_flux REAL,
+    quick INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS fiber_stats_exposure ON fiber_stats (night, expid, camera);
+CREATE INDEX IF NOT EXISTS fiber_stats_model ON fiber_stats (camera, nsky);
+CREATE INDEX IF NOT EXISTS fiber_stats_fiber ON fiber_stats (fiber);
+
+CREATE TABLE IF NOT EXISTS realizations (
+    night INTEGER NOT NULL,
+    expid INTEGER NOT NULL,
+    camera TEXT NOT NULL,
+    nsky INTEGER NOT NULL,
+    rep INTEGER NOT NULL,
+    nfiber INTEGER,
+    mean_rms REAL,
+    quick INTEGER DEFAULT 0,
+    PRIMARY KEY (night, expid, camera, nsky, rep)
+);
+CREATE INDEX IF NOT EXISTS realizations_model ON realizations (camera, nsky);
+
+CREATE TABLE IF NOT EXISTS sources (
+    filename TEXT PRIMARY KEY,
+    night INTEGER,
+    expid INTEGER,
+    mtime REAL,
+    size INTEGER
+);
+'''
+
+FIBER_COLUMNS = ('night', 'expid', 'camera', 'nsky', 'rep', 'fiber', 'rms', 'integrated_flux', 'quick')
+REALIZATION_COLUMNS = ('night', 'expid', 'camera', 'nsky', 'rep', 'nfiber', 'mean_rms', 'quick')
+FLOAT_COLUMNS = ('rms', 'integrated_flux', 'mean_rms')
+
+def connect(dbfile):
+    '''Opens (and creates if needed) the results database dbfile, returns a sqlite3 connection'''
+    conn = sqlite3.connect(os.path.expandvars(dbfile), timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    #- databases created before quick-look results were flagged
+    for table in ('fiber_stats', 'realizations'):
+        columns = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+        if 'quick' not in columns:
+            with conn:
+                conn.execute('ALTER TABLE {} ADD COLUMN quick INTEGER DEFAULT 0'.format(table))
+    return conn
+
+def parse_json_filename(filename):
+    '''Returns (night, expid) from a data-{night}-{expid}.json filename written by run.write_dict_to_json()'''
+    m = re.match(r'data-(\d+)-(\d+)\.json$', os.path.basename(filename))
+    if m is None:
+        raise ValueError('{} is not a data-{{night}}-{{expid}}.json file'.format(filename))
+    return int(m.group(1)), int(m.group(2))
+
+def ingest_dict(dbfile, night, expid, data):
+    '''Adds results for one exposure to the database, replacing any previous results for the same cameras.
+    Args:
+        dbfile: path to the results database
+        night: YYYYMMDD (int)
+        expid: exposure id without padding zeros (int)
+        data: dict {camera: {nsky: {rep: fiber_dict}}} as returned by run.write_rms_dict() for each camera
+    Realizations whose fiber_dict has 'quick' set are flagged as quick-look (subsampled) results.
+    Returns the number of fiber rows added.'''
+    nrows = 0
+    conn = connect(dbfile)
+    with conn:
+        for cam, cam_data in data.items():
+            conn.execute('DELETE FROM fiber_stats WHERE night=? AND expid=? AND camera=?', (night, expid, cam))
+            conn.execute('DELETE FROM realizations WHERE night=? AND expid=? AND camera=?', (night, expid, cam))
+            for nsky, n_data in cam_data.items():
+                for rep, fiber_dict in n_data.items():
+                    rmss = fiber_dict['fiber_RMS']
+                    sums = fiber_dict['integrated_flux']
+                    #- files written before fiber numbers were recorded have no 'fiber' entry
+                    fibers = fiber_dict.get('fiber', [None]*len(rmss))
+                    quick = int(bool(fiber_dict.get('quick', False)))
+                    rows = [(night, expid, cam, int(nsky), int(rep), f, r, y, quick) for f, r, y in zip(fibers, rmss, sums)]
+                    conn.executemany('INSERT INTO fiber_stats ({}) VALUES (?,?,?,?,?,?,?,?,?)'.format(','.join(FIBER_COLUMNS)), rows)
+                    mean_rms = float(np.average(rmss)) if len(rmss) > 0 else None
+                    conn.execute('INSERT INTO realizations ({}) VALUES (?,?,?,?,?,?,?,?)'.format(','.join(REALIZATION_COLUMNS)),
+                                 (night, expid, cam, int(nsky), int(rep), len(rmss), mean_rms, quick))
+                    nrows += len(rows)
+    conn.close()
+    return nrows
+
+def ingest_json(dbfile, filename, force=False):
+    '''Adds the results in a data-{night}-{expid}.json file to the database.
+    Files already ingested are skipped unless they changed on disk since, or force is True.
+    Returns True if the file was ingested.'''
+    filename = os.path.abspath(filename)
+    night, expid = parse_json_filename(filename)
+    stat = os.stat(filename)
+
+    conn = connect(dbfile)
+    row = conn.execute('SELECT mtime, size FROM sources WHERE filename=?', (filename,)).fetchone()
+    conn.close()
+    if not force and row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+        return False
+
+    with open(filename) as json_file:
+        data = json.load(json_file)
+    nrows = ingest_dict(dbfile, night, expid, data)
+
+    conn = connect(dbfile)
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO sources VALUES (?,?,?,?,?)',
+                     (filename, night, expid, stat.st_mtime, stat.st_size))
+    conn.close()
+    print('ingested {} ({} fibers)'.format(filename, nrows))
+    return True
+
+def ingest_paths(dbfile, paths, force=False):
+    '''Ingests json files, or all data-*.json files in directories, from a list of paths.
+    Returns the number of files ingested.'''
+    count = 0
+    for path in paths:
+        path = os.path.expandvars(path)
+        if os.path.isdir(path):
+            filenames = sorted(glob.glob(os.path.join(path, 'data-*-*.json')))
+        else:
+            filenames = [path,]
+        for filename in filenames:
+            if ingest_json(dbfile, filename, force=force):
+                count += 1
+    return count
+
+def _where(**filters):
+    '''Returns (sql, params) for a WHERE clause; filter values can be scalars or lists'''
+    clauses = []
+    params = []
+    for key, value in filters.items():
+        if value is None:
+            continue
+        if np.isscalar(value):
+            clauses.append('{}=?'.format(key))
+            params.append(value)
+        else:
+            value = list(value)
+            clauses.append('{} IN ({})'.format(key, ','.join('?'*len(value))))
+            params.extend(value)
+    if len(clauses) == 0:
+        return '', params
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+def _fetch_arrays(dbfile, sql, params, columns):
+    conn = connect(dbfile)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    result = dict()
+    for i, col in enumerate(columns):
+        values = [row[i] for row in rows]
+        if col == 'camera':
+            result[col] = np.array(values, dtype=str)
+        elif col in FLOAT_COLUMNS:
+            result[col] = np.array([np.nan if v is None else v for v in values], dtype=float)
+        else:
+            #- missing fiber numbers are returned as -1
+            result[col] = np.array([-1 if v is None else v for v in values], dtype=int)
+    return result
+
+def query_fibers(dbfile, night=None, expid=None, camera=None, nsky=None, rep=None, fiber=None, quick=None):
+    '''Returns per-fiber results as a dict of NumPy arrays keyed by column name
+    (night, expid, camera, nsky, rep, fiber, rms, integrated_flux, quick).
+    Each filter can be a single value or a list of values; quick=True or False only selects quick-look
+    or full results.'''
+    where, params = _where(night=night, expid=expid, camera=camera, nsky=nsky, rep=rep, fiber=fiber, 
+                           quick=None if quick is None else int(quick))
+    sql = 'SELECT {} FROM fiber_stats{}'.format(','.join(FIBER_COLUMNS), where)
+    return _fetch_arrays(dbfile, sql, params, FIBER_COLUMNS)
+
+def query_realizations(dbfile, night=None, expid=None, camera=None, nsky=None, rep=None, quick=None):
+    '''Returns the mean RMS of target fibers for each realization as a dict of NumPy arrays
+    (night, expid, camera, nsky, rep, nfiber, mean_rms, quick). Each filter can be a single value or a list;
+    quick=True or False only selects quick-look or full results.'''
+    where, params = _where(night=night, expid=expid, camera=camera, nsky=nsky, rep=rep, 
+                           quick=None if quick is None else int(quick))
+    sql = 'SELECT {} FROM realizations{}'.format(','.join(REALIZATION_COLUMNS), where)
+    return _fetch_arrays(dbfile, sql, params, REALIZATION_COLUMNS)
+
+def query_rms_vs_nsky(dbfile, camera=None, night=None, expid=None, quick=False):
+    '''Returns the RMS vs. number of sky fibers curve over all matching realizations, as a dict of NumPy
+    arrays: nsky, mean (average of the per-realization mean RMS), std (standard deviation across
+    realizations) and nreal (number of realizations).
+    By default only full results are used, quick=True only uses quick-look results and quick=None both.'''
+    where, params = _where(camera=camera, night=night, expid=expid, quick=None if quick is None else int(quick))
+    sql = ('SELECT nsky, AVG(mean_rms), AVG(mean_rms*mean_rms), COUNT(mean_rms) FROM realizations{} '
+           'GROUP BY nsky ORDER BY nsky').format(where)
+    conn = connect(dbfile)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    rows = np.array(rows, dtype=float).reshape(-1, 4)
+    mean = rows[:, 1]
+    std = np.sqrt(np.clip(rows[:, 2] - mean**2, 0, None))
+    return dict(nsky=rows[:, 0].astype(int), mean=mean, std=std, nreal=rows[:, 3].astype(int))
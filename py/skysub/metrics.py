@@ -0,0 +1,246 @@
+"""
+Live progress and throughput metrics of a run, in Prometheus text format
+
+The metrics are rewritten atomically to a file (e.g. for the node_exporter textfile collector) and can be
+served on a local HTTP port, so that stalled or slow nodes can be spotted during long batches.
+"""
+
+import os, time, threading
+from collections import OrderedDict
+
+#- upper bounds in seconds of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.5, 1., 2., 5., 10., 30., 60., 120., 300., 600., 1800.)
+
+STATES = ('pending', 'running', 'done', 'failed', 'skipped')
+
+def _read_io(pid):
+    counters = dict()
+    try:
+        with open('/proc/{}/io'.format(pid)) as fx:
+            for line in fx:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return 0, 0
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+def get_descendants(pid=None):
+    '''Returns the list of pids of the running descendant processes of pid (default this process), from /proc'''
+    if pid is None:
+        pid = os.getpid()
+    children = dict()
+    try:
+        entries = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return []
+    for entry in entries:
+        try:
+            with open('/proc/{}/stat'.format(entry)) as fx:
+                #- the command name in parentheses may contain spaces, the parent pid follows the state
+                ppid = int(fx.read().rpartition(')')[2].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    descendants = []
+    parents = [pid,]
+    while len(parents) > 0:
+        parents = [child for parent in parents for child in children.get(parent, [])]
+        descendants.extend(parents)
+    return descendants
+
+def get_io_counters():
+    '''Returns (bytes read, bytes written) so far by this process and its subprocesses, e.g. desi_compute_sky and
+    the sky fits, from /proc/{pid}/io, or (0, 0) if unavailable. The kernel adds the counters of terminated
+    children to their parent once they are waited for, so only the running descendants are read separately.'''
+    nread, nwritten = _read_io('self')
+    for pid in get_descendants():
+        n, m = _read_io(pid)
+        nread += n
+        nwritten += m
+    return nread, nwritten
+
+class Metrics(object):
+    '''Counters of the tasks of a run by stage and state, completed cells (models), throughput, stage latency
+    histograms and ETA. The scheduler reports each task with register(), started() and finished(), see
+    skysub.scheduler.run_tasks().
+    Options:
+        filename: file the metrics are written to, atomically, at most every interval seconds
+        port: if given, the metrics are also served on http://localhost:port/metrics
+        interval: minimum number of seconds between two writes of filename, default 5
+        buckets: upper bounds in seconds of the latency histogram buckets, default LATENCY_BUCKETS'''
+
+    def __init__(self, filename=None, port=None, interval=5., buckets=LATENCY_BUCKETS):
+        self.filename = filename
+        self.interval = interval
+        self.buckets = tuple(buckets)
+        self.counts = OrderedDict()
+        self.retries = dict()
+        self.latency = dict()
+        #- cell -> number of its tasks not done yet
+        self.cell_tasks = dict()
+        self.cells_done = 0
+        self.cells_failed = set()
+        self.start_time = time.time()
+        self.last_progress = self.start_time
+        self.last_write = None
+        self.io_start = get_io_counters()
+        self.lock = threading.Lock()
+        self.text = ''
+        self.server = None
+        self.update(force=True)
+        if port is not None:
+            self._serve(port)
+
+    def _stage(self, stage):
+        if stage is None:
+            stage = 'task'
+        if stage not in self.counts:
+            self.counts[stage] = dict((state, 0) for state in STATES)
+            self.retries[stage] = 0
+            self.latency[stage] = [[0]*len(self.buckets), 0, 0.]
+        return stage
+
+    def register(self, stage, cell=None):
+        '''Adds a pending task of stage, belonging to cell (e.g. (camera, nsky, rep)) if not None'''
+        with self.lock:
+            stage = self._stage(stage)
+            self.counts[stage]['pending'] += 1
+            if cell is not None:
+                self.cell_tasks[cell] = self.cell_tasks.get(cell, 0) + 1
+
+    def started(self, stage):
+        '''Records that a pending task of stage started running'''
+        with self.lock:
+            stage = self._stage(stage)
+            self.counts[stage]['pending'] -= 1
+            self.counts[stage]['running'] += 1
+
+    def finished(self, stage, seconds, state, cell=None):
+        '''Records the end of a task of stage that ran for seconds (None if it never started).
+        state is 'done', 'failed', 'skipped' (never started) or 'retry' (back to pending).'''
+        with self.lock:
+            stage = self._stage(stage)
+            if seconds is not None:
+                self.counts[stage]['running'] -= 1
+                bucket_counts, count, total = self.latency[stage]
+                for i, upper in enumerate(self.buckets):
+                    if seconds <= upper:
+                        bucket_counts[i] += 1
+                self.latency[stage][1:] = [count + 1, total + seconds]
+            else:
+                self.counts[stage]['pending'] -= 1
+            if state == 'retry':
+                self.counts[stage]['pending'] += 1
+                self.retries[stage] += 1
+                return
+            self.counts[stage][state] += 1
+            if state == 'done':
+                self.last_progress = time.time()
+            if cell is not None and cell in self.cell_tasks:
+                if state == 'done':
+                    self.cell_tasks[cell] -= 1
+                    if self.cell_tasks[cell] == 0 and cell not in self.cells_failed:
+                        self.cells_done += 1
+                else:
+                    self.cells_failed.add(cell)
+
+    def render(self):
+        '''Returns the metrics in Prometheus text exposition format'''
+        now = time.time()
+        elapsed = now - self.start_time
+        nread, nwritten = [n - n0 for n, n0 in zip(get_io_counters(), self.io_start)]
+        with self.lock:
+            ncells = len(self.cell_tasks)
+            nfailed = len(self.cells_failed)
+            rate = self.cells_done / elapsed if elapsed > 0 else 0.
+            remaining = ncells - self.cells_done - nfailed
+            eta = remaining / rate if rate > 0 else float('nan')
+
+            lines = []
+            def metric(name, kind, description, samples):
+                lines.append('# HELP skysub_{} {}'.format(name, description))
+                lines.append('# TYPE skysub_{} {}'.format(name, kind))
+                for labels, value in samples:
+                    if value != value:
+                        value = 'NaN'
+                    labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                    lines.append('skysub_{}{} {}'.format(name, '{'+labels+'}' if labels else '', value))
+
+            metric('tasks', 'gauge', 'Number of tasks by stage and state',
+                   [((('stage', stage), ('state', state)), counts[state])
+                    for stage, counts in self.counts.items() for state in STATES])
+            metric('task_retries_total', 'counter', 'Number of task retries by stage',
+                   [((('stage', stage),), n) for stage, n in self.retries.items()])
+            metric('cells', 'gauge', 'Number of cells (models) by state',
+                   [((('state', 'total'),), ncells), ((('state', 'done'),), self.cells_done),
+                    ((('state', 'failed'),), nfailed), ((('state', 'remaining'),), remaining)])
+            metric('cells_per_second', 'gauge', 'Cells completed per second since the start of the run', [((), rate)])
+            metric('read_bytes_total', 'counter', 'Bytes read by this process and its subprocesses since the start of the run', [((), nread)])
+            metric('write_bytes_total', 'counter', 'Bytes written by this process and its subprocesses since the start of the run', [((), nwritten)])
+            metric('read_bytes_per_second', 'gauge', 'Bytes read per second since the start of the run',
+                   [((), nread / elapsed if elapsed > 0 else 0.)])
+            metric('write_bytes_per_second', 'gauge', 'Bytes written per second since the start of the run',
+                   [((), nwritten / elapsed if elapsed > 0 else 0.)])
+
+            lines.append('# HELP skysub_stage_seconds Run time of the tasks by stage')
+            lines.append('# TYPE skysub_stage_seconds histogram')
+            for stage, (bucket_counts, count, total) in self.latency.items():
+                for upper, n in zip(self.buckets, bucket_counts):
+                    lines.append('skysub_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, upper, n))
+                lines.append('skysub_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, count))
+                lines.append('skysub_stage_seconds_sum{{stage="{}"}} {}'.format(stage, total))
+                lines.append('skysub_stage_seconds_count{{stage="{}"}} {}'.format(stage, count))
+
+            metric('elapsed_seconds', 'gauge', 'Seconds since the start of the run', [((), elapsed)])
+            metric('eta_seconds', 'gauge', 'Estimated seconds until all remaining cells are done', [((), eta)])
+            metric('last_progress_timestamp_seconds', 'gauge', 'Unix time of the last task completion',
+                   [((), self.last_progress)])
+        return '\n'.join(lines) + '\n'
+
+    def update(self, force=False):
+        '''Renders the metrics and writes them to filename, if interval seconds passed since the last write or force'''
+        now = time.time()
+        if not force and self.last_write is not None and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+        self.text = self.render()
+        if self.filename is not None:
+            #- write and rename, so that readers never see a partial file
+            tmpfile = self.filename + '.tmp'
+            with open(tmpfile, 'w') as fx:
+                fx.write(self.text)
+            os.replace(tmpfile, self.filename)
+
+    def _serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        #- only local connections, like skysub serve-plots
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print('serving metrics on http://localhost:{}/metrics'.format(port))
+
+    def close(self):
+        '''Writes the final metrics and stops the HTTP server'''
+        try:
+            self.update(force=True)
+        finally:
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+                self.server = None
@@ -1,5 +1,6 @@
-import os, sys, time, subprocess
+import os, sys, time, signal, shutil, subprocess, traceback
 from copy import deepcopy
+from functools import lru_cache
 import bokeh.plotting as bk
 import numpy as np
 import fitsio
@@ -8,15 +9,18 @@ from desispec.sky import subtract_sky
 from desispec.fiberflat import apply_fiberflat
 from desispec.calibfinder import findcalibfile
 from desitarget.targetmask import desi_mask
+from .staging import staged_path
+from . import shm
+from . import storage as products
 from bokeh.layouts import row, column, gridplot
 from bokeh.models import ColumnDataSource
 from bokeh.embed import file_html
 from bokeh.resources import Resources
 
-def pick_sky_fibers(frame, fiberflat, nsky=100):
+def get_sky_candidates(frame, fiberflat):
     '''
-    Updates frame in-place with a new set of sky fibers
-    
+    Returns a boolean array of the fibers that are eligible to be flagged as sky
+
     The particular cuts here only work for early commissioning observations
     where we randomly point the telescope and hope that most fibers don't
     hit a star or galaxy.
@@ -29,10 +33,13 @@ def pick_sky_fibers(frame, fiberflat, nsky=100):
     sumivar = np.sum(tmpframe.ivar, axis=1)
     fluxlo, fluxhi = np.percentile(sumflux, [5, 85])
     iisky = (fluxlo < sumflux) & (sumflux < fluxhi) & (sumivar>0) & (sumflux > 0)
+    return iisky
 
-    #- Pick a random subset for calling "SKY" fibers
-    skysubset = np.random.choice(np.where(iisky)[0], size=nsky, replace=False)
-
+def flag_sky_fibers(frame, iisky, skysubset):
+    '''
+    Updates frame fibermap in-place: fibers in skysubset are flagged "SKY",
+    fibers not in iisky are flagged "BAD" and the rest are flagged "TGT"
+    '''
     #- everything is a target unless told otherwise
     frame.fibermap['OBJTYPE'] = 'TGT'
     
@@ -42,9 +49,71 @@ def pick_sky_fibers(frame, fiberflat, nsky=100):
     
     #- Flag the subset as "SKY"
     frame.fibermap['OBJTYPE'][skysubset] = 'SKY'
+
+def pick_sky_fibers(frame, fiberflat, nsky=100):
+    '''
+    Updates frame in-place with a new set of sky fibers
     
-    
-def get_new_frame(night, expid, camera, basedir, nsky, rep=0):
+    The particular cuts here only work for early commissioning observations
+    where we randomly point the telescope and hope that most fibers don't
+    hit a star or galaxy.
+    '''
+    iisky = get_sky_candidates(frame, fiberflat)
+
+    #- Pick a random subset for calling "SKY" fibers
+    skysubset = np.random.choice(np.where(iisky)[0], size=nsky, replace=False)
+
+    flag_sky_fibers(frame, iisky, skysubset)
+
+def get_cell_filename(kind, camera, expid, nsky, rep, basedir, storage='fits'):
+    '''Returns the path of a generated product in basedir, following the convention
+    {kind}-{camera}-{expid (padded to 8 digits)}-{number of fibers}-{rep}.fits,
+    where kind is 'frame', 'sky', 'csky' (compact sky model) or 'sframe'.
+    With storage='hdf5' the path points to the product in the exposure container, see skysub.storage.'''
+    return products.get_product_path(kind, camera, expid, nsky, rep, basedir, storage=storage)
+
+def get_input_files(night, expid, camera):
+    '''Returns (framefile, fiberflatfile) of the pipeline products for a given camera and exposure.
+    Files staged to local scratch with skysub.staging resolve to their local copies.'''
+    framefile = staged_path(desispec.io.findfile('frame', night, expid, camera=camera))
+    header = fitsio.read_header(framefile)
+    fiberflatfile = staged_path(findcalibfile([header,], 'FIBERFLAT'))
+    return framefile, fiberflatfile
+
+def read_inputs(night, expid, camera):
+    '''Returns (frame, fiberflat) of the pipeline products for a given camera and exposure.
+    If this process is attached to the node-local shared store of the camera (see skysub.shm),
+    they are built on its shared arrays instead of being read from disk.'''
+    if shm.is_attached(night, expid, camera):
+        return shm.read_frame(night, expid, camera), shm.read_fiberflat(night, expid, camera)
+    framefile, fiberflatfile = get_input_files(night, expid, camera)
+    print(framefile)
+    frame = desispec.io.read_frame(framefile)
+    fiberflat = read_fiberflat(fiberflatfile)
+    print(fiberflatfile)
+    return frame, fiberflat
+
+@lru_cache(maxsize=16)
+def read_fiberflat(fiberflatfile):
+    '''Cached desispec.io.read_fiberflat(), the same fiberflat is used by every model of a camera.
+    The returned fiberflat is shared and must not be modified.'''
+    return desispec.io.read_fiberflat(fiberflatfile)
+
+def get_fiberflat(night, expid, camera):
+    '''Returns the fiberflat for a given camera and exposure, from the shared store if attached (see skysub.shm)'''
+    if shm.is_attached(night, expid, camera):
+        return shm.read_fiberflat(night, expid, camera)
+    framefile, fiberflatfile = get_input_files(night, expid, camera)
+    return read_fiberflat(fiberflatfile)
+
+def read_exposure_sky(night, expid, camera):
+    '''Returns the pipeline sky model for a given camera and exposure, from the shared store if attached (see skysub.shm)'''
+    if shm.is_attached(night, expid, camera):
+        return shm.read_sky(night, expid, camera)
+    skyfile = staged_path(desispec.io.findfile('sky', night, expid, camera=camera))
+    return desispec.io.read_sky(skyfile)
+    
+def get_new_frame(night, expid, camera, basedir, nsky, rep=0, storage='fits'):
     '''For a given frame file, returns an updated frame file to the basedir with a certain number of sky fibers.
     Args:
         night: YYYYMMDD (float)
@@ -54,22 +123,17 @@ def get_new_frame(night, expid, camera, basedir, nsky, rep=0):
         nsky: number of fibers flagged sky in new frame fibermap
     Options:
         rep: number of different frame files you want (with same number of sky fibers), default is 5
-    Writes a new frame file with desispec.io.write_frame().'''
+        storage: 'fits' or 'hdf5', see skysub.storage. Default is 'fits'
+    Writes a new frame file, or a new frame in the exposure container with storage='hdf5'.'''
     
-    framefile = desispec.io.findfile('frame', night, expid, camera=camera)
-    print(framefile)
-    header = fitsio.read_header(framefile)
-    fiberflatfile = findcalibfile([header,], 'FIBERFLAT')
-    frame = desispec.io.read_frame(framefile)
-    fiberflat = desispec.io.read_fiberflat(fiberflatfile)
-    print(fiberflatfile)
+    frame, fiberflat = read_inputs(night, expid, camera)
     pick_sky_fibers(frame, fiberflat, nsky=nsky)
 
     #- output updated frame to current directory
-    newframefile = basedir+'/frame-{}-{:08d}-{}-{}.fits'.format(camera, expid, nsky, rep)
-    desispec.io.write_frame(newframefile, frame)
+    newframefile = get_cell_filename('frame', camera, expid, nsky, rep, basedir, storage=storage)
+    products.write_frame(newframefile, frame)
     
-def get_new_frame_set(night, expid, cameras, basedir, nsky_list, reps=None):
+def get_new_frame_set(night, expid, cameras, basedir, nsky_list, reps=None, by_petal=False, storage='fits'):
     '''For a given frame file, returns an updated set of frame files to the basedir, given a list of different numbers of sky fibers.
     Args:
         night: YYYYMMDD (float)
@@ -79,17 +143,87 @@ def get_new_frame_set(night, expid, cameras, basedir, nsky_list, reps=None):
         nsky_list: list with different numbers of fibers you want frame files to be generated with.
     Options:
         rep: number of different frame files you want for each camera and nsky combination. Default is 5
+        by_petal: if True, cameras of the same petal share one set of sky fibers per model, see
+            get_new_petal_frames(). Default is False
+        storage: 'fits' or 'hdf5', see skysub.storage. Default is 'fits'
     Writes new frame files with desispec.io.write_frame(), frames are named according to the convention frame-{camera}-{expid (padded to 8 digits)}-{number of fibers}-{rep}.fits'.'''
 
     if reps == None:
         reps = 5
+
+    if by_petal:
+        for petal, petal_cameras in get_petal_cameras(cameras).items():
+            get_new_petal_frames(night, expid, petal, basedir, nsky_list, reps=reps, 
+                                 arms=[cam[0] for cam in petal_cameras], storage=storage)
+        return
         
     for cam in cameras:
         for N in range(reps):
             for n in nsky_list:
-                get_new_frame(night, expid, cam, basedir, n, rep=N)
-                
-def run_compute_sky(night, expid, cameras, basedir, nsky_list, reps=None):
+                get_new_frame(night, expid, cam, basedir, n, rep=N, storage=storage)
+
+def get_petal_cameras(cameras):
+    '''Groups a list of cameras by petal, e.g. ['b3', 'r3', 'z3', 'r4'] -> {'3': ['b3', 'r3', 'z3'], '4': ['r4']}'''
+    petals = dict()
+    for cam in cameras:
+        petals.setdefault(cam[1:], []).append(cam)
+    return petals
+
+def get_new_petal_frames(night, expid, petal, basedir, nsky_list, reps=None, arms=('b', 'r', 'z'), cells=None,
+                         storage='fits'):
+    '''For a given petal, writes new frame files for all of its arms using one shared set of sky fibers per model.
+    The b, r and z cameras of a petal see the same fibers, so the eligible fibers (those passing the cuts in
+    every arm) and the random draw of sky fibers are computed once per petal, see select_petal_sky_fibers(),
+    and the frames of each model are then flagged and written by write_petal_frames().
+    Args:
+        night: YYYYMMDD (float)
+        expid: exposure id without padding zeros (float)
+        petal: petal number, example 3 for cameras b3, r3, z3 (int or string)
+        basedir: path to directory you want new frame files to be written
+        nsky_list: list with different numbers of fibers you want frame files to be generated with.
+    Options:
+        reps: number of different frame files you want for each nsky, default is 5
+        arms: arms of the petal to generate frame files for, default is ('b', 'r', 'z')
+        cells: list of (nsky, rep) to generate frame files for, instead of all combinations of nsky_list and reps
+        storage: 'fits' or 'hdf5', see skysub.storage. Default is 'fits'
+    Writes new frame files with desispec.io.write_frame(), named as in get_new_frame_set().'''
+    
+    if reps == None:
+        reps = 5
+    if cells is None:
+        cells = [(n, N) for N in range(reps) for n in nsky_list]
+
+    iisky, selections = select_petal_sky_fibers(night, expid, petal, cells, arms=arms)
+    for n, N in cells:
+        write_petal_frames(night, expid, petal, basedir, n, N, iisky, selections[(n, N)], arms=arms, storage=storage)
+
+def select_petal_sky_fibers(night, expid, petal, cells, arms=('b', 'r', 'z')):
+    '''Returns (iisky, selections) for the models cells [(nsky, rep), ...] of a petal: iisky is the boolean
+    array of the fibers passing the cuts of get_sky_candidates() in every arm, and selections the dict
+    {(nsky, rep): sky fibers} of the random draws of sky fibers among them, shared by all the arms'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    cameras = ['{}{}'.format(arm, petal) for arm in arms]
+    with ThreadPoolExecutor(max_workers=len(cameras)) as pool:
+        candidates = list(pool.map(lambda cam: get_sky_candidates(*read_inputs(night, expid, cam)), cameras))
+
+    #- a fiber is only a sky candidate if it passes the cuts in every arm
+    iisky = np.logical_and.reduce(candidates)
+    selections = dict()
+    for n, N in cells:
+        selections[(n, N)] = np.random.choice(np.where(iisky)[0], size=n, replace=False)
+    return iisky, selections
+
+def write_petal_frames(night, expid, petal, basedir, nsky, rep, iisky, skysubset, arms=('b', 'r', 'z'), storage='fits'):
+    '''Writes the new frame files of one model of a petal, one per arm, with the sky fibers skysubset and the
+    fibers not in iisky flagged BAD, see select_petal_sky_fibers() and flag_sky_fibers()'''
+    for arm in arms:
+        cam = '{}{}'.format(arm, petal)
+        frame, fiberflat = read_inputs(night, expid, cam)
+        flag_sky_fibers(frame, iisky, skysubset)
+        products.write_frame(get_cell_filename('frame', cam, expid, nsky, rep, basedir, storage=storage), frame)
+
+def run_compute_sky(night, expid, cameras, basedir, nsky_list, reps=None, sky_format='full', storage='fits'):
     '''Generates sky models for new frame files, using --no-extra-variance option, which doesn't inflate the output errors for sky subtraction systematics.
     Args:
         night: YYYYMMDD (float)
@@ -99,29 +233,102 @@ def run_compute_sky(night, expid, cameras, basedir, nsky_list, reps=None):
         nsky_list: list with different numbers of fibers frame files were generated with.
     Options:
         rep: number of different frame files for each camera and nsky combination. Default is 5
+        sky_format: 'full' writes the sky of every fiber (sky-*.fits) with desi_compute_sky, 'compact' only 
+            writes the deconvolved sky spectrum (csky-*.fits), see skysub.skymodel. Default is 'full'
+        storage: 'fits' or 'hdf5', see skysub.storage. Default is 'fits'
     '''
     
     if reps == None:
         reps = 5
     
     for cam in cameras:
-        framefile = desispec.io.findfile('frame', night, expid, camera=cam)
-        header = fitsio.read_header(framefile)
-        fiberflatfile = findcalibfile([header,], 'FIBERFLAT')
         for N in range(reps):
             for n in nsky_list:
-                newframefile = basedir+'/frame-{}-{:08d}-{}-{}.fits'.format(cam, expid, n, N)
-                skyfile = basedir+'/sky-{}-{:08d}-{}-{}.fits'.format(cam, expid, n, N)
-                cmd = 'desi_compute_sky -i {} --fiberflat {} -o {} --no-extra-variance'.format(
-                    newframefile, fiberflatfile, skyfile)
-                print('RUNNING {}'.format(cmd))
-                err = subprocess.call(cmd.split())
-                if err:
-                    print('FAILED')
-                else:
-                    print('OK')
+                compute_sky(night, expid, cam, basedir, n, N, sky_format=sky_format, storage=storage)
+
+def compute_sky(night, expid, cam, basedir, nsky, rep, check=False, sky_format='full', storage='fits'):
+    '''Generates the sky model of a single new frame file with desi_compute_sky --no-extra-variance, see run_compute_sky().
+    Returns the exit code of desi_compute_sky, or raises RuntimeError if it failed and check is True.
+    The compact and hdf5 sky models are fitted in a child process, like desi_compute_sky, so that the
+    out-of-memory killer only kills the fit: with check, a fit killed by SIGKILL raises MemoryError and
+    the scheduler reschedules it alone. The other stages still run in the threads of the scheduler.'''
+    newframefile = get_cell_filename('frame', cam, expid, nsky, rep, basedir, storage=storage)
+    if sky_format == 'compact':
+        return run_in_child(compute_compact_sky, newframefile, get_fiberflat(night, expid, cam), 
+                            get_cell_filename('csky', cam, expid, nsky, rep, basedir, storage=storage), check=check)
+    if storage == 'hdf5':
+        #- desi_compute_sky can only read and write files, fit the same model in a child process
+        return run_in_child(compute_full_sky, newframefile, get_fiberflat(night, expid, cam),
+                            get_cell_filename('sky', cam, expid, nsky, rep, basedir, storage=storage), check=check)
+
+    framefile, fiberflatfile = get_input_files(night, expid, cam)
+    skyfile = get_cell_filename('sky', cam, expid, nsky, rep, basedir)
+    cmd = 'desi_compute_sky -i {} --fiberflat {} -o {} --no-extra-variance'.format(
+        newframefile, fiberflatfile, skyfile)
+    print('RUNNING {}'.format(cmd))
+    err = subprocess.call(cmd.split())
+    if err:
+        print('FAILED')
+        if check and err == -signal.SIGKILL:
+            #- most likely killed by the out-of-memory killer, the scheduler reschedules it
+            raise MemoryError('{} was killed'.format(cmd))
+        if check:
+            raise RuntimeError('{} failed with exit code {}'.format(cmd, err))
+    else:
+        print('OK')
+    return err
+
+#- exit code of a child process that ran out of memory, as if it had been killed by SIGKILL
+OOM_EXIT_CODE = 128 + signal.SIGKILL
+
+def _child_main(func, args):
+    try:
+        func(*args)
+    except MemoryError:
+        traceback.print_exc()
+        sys.exit(OOM_EXIT_CODE)
+
+def run_in_child(func, *args, check=False):
+    '''Runs func(*args) in a new (spawned) process and waits for it. Returns its exit code, or if check is True
+    raises MemoryError if it was killed by SIGKILL (most likely by the out-of-memory killer) or ran out of
+    memory, and RuntimeError if it failed otherwise. func and args must be picklable.'''
+    import multiprocessing
 
-def run_sky_subtraction(night, expid, cameras, basedir, nsky_list, reps=None):
+    #- spawn instead of fork, forking a process with running threads can deadlock the child
+    proc = multiprocessing.get_context('spawn').Process(target=_child_main, args=(func, args))
+    proc.start()
+    proc.join()
+    err = proc.exitcode
+    if err:
+        print('FAILED {} with exit code {}'.format(func.__name__, err))
+        if check and err in (-signal.SIGKILL, OOM_EXIT_CODE):
+            raise MemoryError('{} was killed'.format(func.__name__))
+        if check:
+            raise RuntimeError('{} failed with exit code {}'.format(func.__name__, err))
+    return err
+
+def compute_compact_sky(framefile, fiberflat, cskyfile):
+    '''Fits the deconvolved sky spectrum of a new frame file and writes it to cskyfile, see skysub.skymodel'''
+    from . import skymodel
+
+    frame = products.read_frame(framefile)
+    apply_fiberflat(frame, fiberflat)
+    skyflux, skyivar, mask, covar = skymodel.fit_compact_sky(frame)
+    products.write_compact_sky(cskyfile, frame.wave, skyflux, skyivar, mask, covar=covar)
+    print('wrote {}'.format(cskyfile))
+
+def compute_full_sky(framefile, fiberflat, skyfile):
+    '''Computes the sky of every fiber of a new frame file as desi_compute_sky --no-extra-variance does,
+    in this process, and writes it to skyfile'''
+    from desispec.sky import compute_sky as desispec_compute_sky
+
+    frame = products.read_frame(framefile)
+    apply_fiberflat(frame, fiberflat)
+    sky = desispec_compute_sky(frame, add_variance=False)
+    products.write_sky(skyfile, sky)
+    print('wrote {}'.format(skyfile))
+
+def run_sky_subtraction(night, expid, cameras, basedir, nsky_list, reps=None, sky_format='full', storage='fits'):
     '''Runs sky subtraction with new sky models and frame files.
     Args:
         night: YYYYMMDD (float)
@@ -131,37 +338,49 @@ def run_sky_subtraction(night, expid, cameras, basedir, nsky_list, reps=None):
         nsky_list: list with different numbers of fibers frame files and sky files were generated with.
     Options:
         rep: number of different frame/sky files for each camera and nsky combination. Default is 5
+        sky_format: format the sky models were written with by run_compute_sky(), 'full' or 'compact'
+        storage: 'fits' or 'hdf5', see skysub.storage. Default is 'fits'
     '''
     if reps == None:
         reps = 5
     
     for cam in cameras:
-        framefile = desispec.io.findfile('frame', night, expid, camera=cam)
-        header = fitsio.read_header(framefile)
-        fiberflatfile = findcalibfile([header,], 'FIBERFLAT')
-        fiberflat = desispec.io.read_fiberflat(fiberflatfile)
         for N in range(reps):
             for n in nsky_list:
-                newframefile = basedir+'/frame-{}-{:08d}-{}-{}.fits'.format(cam, expid, n, N)
-                skyfile = basedir+'/sky-{}-{:08d}-{}-{}.fits'.format(cam, expid, n, N)
-                sframe = desispec.io.read_frame(newframefile)
-                sky = desispec.io.read_sky(skyfile)
-                apply_fiberflat(sframe, fiberflat)
-                subtract_sky(sframe, sky)
+                subtract_sky_cell(night, expid, cam, basedir, n, N, sky_format=sky_format, storage=storage)
+
+def subtract_sky_cell(night, expid, cam, basedir, nsky, rep, sky_format='full', storage='fits'):
+    '''Runs sky subtraction for a single new frame file and its sky model, see run_sky_subtraction().
+    Returns the name of the sframe file written.'''
+    fiberflat = get_fiberflat(night, expid, cam)
+    newframefile = get_cell_filename('frame', cam, expid, nsky, rep, basedir, storage=storage)
+    sframe = products.read_frame(newframefile)
+    if sky_format == 'compact':
+        from . import skymodel
+        compact = products.read_compact_sky(get_cell_filename('csky', cam, expid, nsky, rep, basedir, storage=storage))
+        #- all models of a camera share the resolution data of the original frame
+        sky = skymodel.expand_sky(compact, sframe, cache_key=(night, expid, cam))
+    else:
+        sky = products.read_sky(get_cell_filename('sky', cam, expid, nsky, rep, basedir, storage=storage))
+    apply_fiberflat(sframe, fiberflat)
+    subtract_sky(sframe, sky)
 
-                sframefile = basedir+'/sframe-{}-{:08d}-{}-{}.fits'.format(cam, expid, n, N)
-                desispec.io.write_frame(sframefile, sframe)
+    sframefile = get_cell_filename('sframe', cam, expid, nsky, rep, basedir, storage=storage)
+    products.write_frame(sframefile, sframe)
+    return sframefile
 
 def rms(x):
     return np.sqrt(np.sum(x**2)/len(x))
 
-def get_rms_array(expid, cam, rep, basedir, nsky_list, wave_filter, title=None):
+def get_rms_array(expid, cam, rep, basedir, nsky_list, wave_filter, title=None, storage='fits'):
     '''For a given camera for a given exposure, calculates the rms '''
     basedir = os.path.expandvars(basedir)
+    existing = products.list_products(basedir, expid, storage=storage)
     RMS = []
     for N in nsky_list:
-        if os.path.isfile(basedir+'/sframe-{cam}-{expid:08d}-{n}-{m}.fits'.format(expid=expid, cam=cam, n=str(N), m=str(rep))):
-            frame = desispec.io.read_frame(basedir+'/sframe-{cam}-{expid:08d}-{n}-{m}.fits'.format(expid=expid, cam=cam, n=str(N), m=str(rep)))
+        sframefile = get_cell_filename('sframe', cam, expid, N, rep, basedir, storage=storage)
+        if sframefile in existing:
+            frame = products.read_frame(sframefile)
             isSky = frame.fibermap['OBJTYPE'] == 'SKY'
             rmss = []
             for i in np.where(frame.fibermap['OBJTYPE'] == 'TGT')[0]:
@@ -172,69 +391,266 @@ def get_rms_array(expid, cam, rep, basedir, nsky_list, wave_filter, title=None):
             continue
     return RMS
 
-def write_rms_dict(night, expid, cam, basedir, nsky_list, wave_filter, reps=None):
+#- default wavelength bins of the residual cube, common to all cameras
+WAVE_BINS = np.arange(3500., 10000.1, 10.)
+
+#- reduced grid and sampling of quick-look runs, see get_quick_grid() and get_cell_stats()
+QUICK_NSKY = 4
+QUICK_REPS = 2
+QUICK_NFIBER = 100
+QUICK_WAVE_STEP = 4
+
+def get_cell_stats(sframefile, wave_filter, wave_bins=None, nfiber=None, wave_step=1):
+    '''Returns (fiber_dict, residuals) for a sky subtracted frame file, computed in one pass over its flux.
+    fiber_dict has the rms ('fiber_RMS'), integrated flux ('integrated_flux') and fiber number ('fiber') over
+    wave_filter of each target fiber. If wave_bins (bin edges in Angstrom) is given, residuals is a 
+    dict of arrays per wavelength bin over all target fiber pixels with ivar>0: 'mean' and 'rms' of the flux, 
+    'chi2' (mean of flux**2*ivar) and 'npix' (number of pixels); otherwise residuals is None.
+    For quick-look statistics, nfiber only uses a random subsample of that many target fibers and wave_step 
+    only every wave_step-th wavelength; fiber_dict then has 'quick' set to True. sframefile can also be a product path in an hdf5 container, see skysub.storage.'''
+    frame = products.read_frame(sframefile)
+    tgt = np.where(frame.fibermap['OBJTYPE'] == 'TGT')[0]
+    if nfiber is not None and nfiber < len(tgt):
+        tgt = np.sort(np.random.choice(tgt, size=nfiber, replace=False))
+    flux = frame.flux[tgt]
+
+    fluxw = flux[:, np.where(wave_filter)[0][::wave_step]]
+    fiber_dict = dict({'fiber_RMS': np.sqrt(np.sum(fluxw**2, axis=1)/fluxw.shape[1]).tolist(),
+                       'integrated_flux': np.sum(fluxw, axis=1).tolist(),
+                       'fiber': [int(f) for f in frame.fibermap['FIBER'][tgt]]})
+    if nfiber is not None or wave_step > 1:
+        #- flags subsampled results in the json files and the results database
+        fiber_dict['quick'] = True
+    if wave_bins is None:
+        return fiber_dict, None
+
+    nbins = len(wave_bins) - 1
+    ibin = np.digitize(frame.wave[::wave_step], wave_bins) - 1
+    inbin = (ibin >= 0) & (ibin < nbins)
+    flux = flux[:, ::wave_step]
+    ivar = frame.ivar[tgt, ::wave_step]
+    good = ivar > 0
+    #- sum over fibers first, then over the wavelengths of each bin
+    def binsum(x):
+        return np.bincount(ibin[inbin], weights=np.sum(x, axis=0)[inbin], minlength=nbins)
+    npix = binsum(good)
+    sumflux = binsum(flux*good)
+    sumflux2 = binsum(flux**2*good)
+    sumchi2 = binsum(flux**2*ivar*good)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        residuals = dict(mean=sumflux/npix, rms=np.sqrt(sumflux2/npix), chi2=sumchi2/npix, npix=npix)
+    return fiber_dict, residuals
+
+def get_quick_grid(nsky_list, nsky=QUICK_NSKY):
+    '''Returns about nsky distinct values of nsky_list, evenly spread over the sorted list and including its ends'''
+    nsky_list = sorted(set(nsky_list))
+    if len(nsky_list) <= nsky:
+        return nsky_list
+    ii = np.unique(np.round(np.linspace(0, len(nsky_list)-1, nsky)).astype(int))
+    return [nsky_list[i] for i in ii]
+
+def bootstrap_rms_curve(cam_data, nsky_list, nboot=500, cl=0.95):
+    '''Returns the RMS vs. number of sky fibers curve of one camera with bootstrap confidence intervals.
+    Args:
+        cam_data: dict {nsky: {rep: fiber_dict}} as returned by write_rms_dict() (keys can be int or str)
+        nsky_list: list of numbers of sky fibers
+    Options:
+        nboot: number of bootstrap samples, default 500
+        cl: confidence level of the interval, default 0.95
+    The curve is the mean over realizations of the mean target fiber RMS. Bootstrap samples resample both the
+    realizations and the fibers within them, so the interval includes the sampling error of quick-look runs.
+    Returns dict of lists nsky, mean, lo, hi and nreal; NaN where there are no results.'''
+    curve = dict(nsky=list(nsky_list), mean=[], lo=[], hi=[], nreal=[])
+    for n in nsky_list:
+        n_data = cam_data.get(n, cam_data.get(str(n), dict()))
+        rmss = [np.asarray(d['fiber_RMS']) for d in n_data.values() if len(d['fiber_RMS']) > 0]
+        curve['nreal'].append(len(rmss))
+        if len(rmss) == 0:
+            for key in ('mean', 'lo', 'hi'):
+                curve[key].append(np.nan)
+            continue
+        #- realizations drawn by each bootstrap sample, then the mean of a resampling of the fibers of each draw
+        ii = np.random.randint(len(rmss), size=(nboot, len(rmss)))
+        draws = np.zeros(ii.shape)
+        for i, rms_i in enumerate(rmss):
+            drawn = ii == i
+            draws[drawn] = np.mean(rms_i[np.random.randint(len(rms_i), size=(np.count_nonzero(drawn), len(rms_i)))], axis=1)
+        boots = np.mean(draws, axis=1)
+        lo, hi = np.percentile(boots, [50*(1-cl), 100-50*(1-cl)])
+        curve['mean'].append(float(np.mean([np.mean(r) for r in rmss])))
+        curve['lo'].append(float(lo))
+        curve['hi'].append(float(hi))
+    return curve
+
+def save_rms_curve(night, expid, data, nsky_list, jsondir, quick=False):
+    '''Writes the bootstrap_rms_curve() of each camera of data {camera: {nsky: {rep: fiber_dict}}} to 
+    jsondir/curve-{night}-{expid}.json, flagged as a quick-look result if quick; quick-look curves are also
+    printed. Returns the filename.'''
+    import json
+
+    curves = dict(quick=quick, cameras=dict())
+    for cam, cam_data in data.items():
+        curves['cameras'][cam] = bootstrap_rms_curve(cam_data, nsky_list)
+        if not quick:
+            continue
+        print('{} RMS vs nsky:'.format(cam))
+        for n, mean, lo, hi in zip(*[curves['cameras'][cam][key] for key in ('nsky', 'mean', 'lo', 'hi')]):
+            print('  {:4d} {:10.3f} [{:.3f}, {:.3f}]'.format(n, mean, lo, hi))
+
+    filename = jsondir + '/curve-{}-{:08d}.json'.format(night, expid)
+    with open(filename, 'w') as outfile:
+        json.dump(curves, outfile)
+    print('wrote {}'.format(filename))
+    return filename
+
+def write_rms_dict(night, expid, cam, basedir, nsky_list, wave_filter, reps=None, wave_bins=None, residuals=None, quick=False,
+                   storage='fits', metrics=None):
+    '''Returns dict {nsky: {rep: fiber_dict}} with the statistics of get_cell_stats() for each sframe file of a camera.
+    If residuals is a dict, the per-wavelength residuals of each sframe computed in the same pass over wave_bins 
+    (default WAVE_BINS) are stored in it, keyed by (nsky, rep), see get_cell_stats().
+    If quick, the statistics only use subsamples of fibers and wavelengths (QUICK_NFIBER, QUICK_WAVE_STEP).
+    storage is 'fits' or 'hdf5', see skysub.storage. If metrics (skysub.metrics.Metrics) is given, the statistics of 
+    each sframe are reported to it as a 'stats' task of cell (cam, nsky, rep), which must already be registered.'''
     
     if reps == None:
         reps = 5
+    if wave_bins is None:
+        wave_bins = WAVE_BINS
+    stats_kwargs = dict()
+    if residuals is not None:
+        stats_kwargs.update(wave_bins=wave_bins)
+    if quick:
+        stats_kwargs.update(nfiber=QUICK_NFIBER, wave_step=QUICK_WAVE_STEP)
     
     data = dict()
-    skyfile = desispec.io.findfile('sky', night, expid, camera=cam)
-    sky = desispec.io.read_sky(skyfile)
+    existing = products.list_products(basedir, expid, storage=storage)
 
     for N in nsky_list:
         M_dict = {}
         for M in range(reps):
-            if os.path.isfile(basedir+'/sframe-{cam}-{expid:08d}-{n}-{m}.fits'.format(expid=expid, cam=cam, n=str(N), m=str(M))):
-                frame = desispec.io.read_frame(basedir+'/sframe-{cam}-{expid:08d}-{n}-{m}.fits'.format(expid=expid, cam=cam, n=str(N), m=str(M)))
-                rmss = []
-                sums = []
-                for i in np.where(frame.fibermap['OBJTYPE'] == 'TGT')[0]:
-                    r = rms(frame.flux[i][wave_filter])
-                    rmss.append(r)
-                    y_sum = np.sum(frame.flux[i][wave_filter])
-                    sums.append(y_sum)
-                fiber_dict = dict({'fiber_RMS': rmss, 'integrated_flux': sums})
-                M_dict[M] = fiber_dict      
+            sframefile = get_cell_filename('sframe', cam, expid, N, M, basedir, storage=storage)
+            if sframefile in existing:
+                if metrics is not None:
+                    metrics.started('stats')
+                t0 = time.time()
+                M_dict[M], cell_residuals = get_cell_stats(sframefile, wave_filter, **stats_kwargs)
+                if residuals is not None:
+                    residuals[(N, M)] = cell_residuals
+                if metrics is not None:
+                    metrics.finished('stats', time.time() - t0, 'done', cell=(cam, N, M))
+                    metrics.update()
             else:
+                if metrics is not None:
+                    metrics.finished('stats', None, 'skipped', cell=(cam, N, M))
                 continue
         data[N] = M_dict
     return data
         
-def write_dict_to_json(night, expid, cameras, basedir, jsondir, nsky_list, wave_filters, reps=None):
-    
-    import json
+def write_dict_to_json(night, expid, cameras, basedir, jsondir, nsky_list, wave_filters, reps=None, dbfile=None, cube=True, 
+                       quick=False, storage='fits', metrics_file=None, metrics_port=None):
+    '''Writes the per-fiber statistics of write_rms_dict() for each camera to jsondir/data-{night}-{expid}.json,
+    and the RMS vs. nsky curves with bootstrap confidence intervals to jsondir/curve-{night}-{expid}.json.
+    If dbfile is given, the results are also ingested into that results database, see skysub.db.
+    If cube is True, the per-wavelength residuals are also written to jsondir/cube-{night}-{expid}.npz, 
+    see save_residual_cube().
+    If quick is True, only a reduced grid of models and subsamples of fibers and wavelengths are used, see 
+    get_quick_grid(); a later full run overwrites the same files.
+    storage is the format the sframes were written with, 'fits' or 'hdf5', see skysub.storage.
+    If metrics_file or metrics_port is given, live progress metrics are written to that file and served on
+    that local port, see skysub.metrics.'''
     
     if reps == None:
         reps = 5
+    if quick:
+        nsky_list = get_quick_grid(nsky_list)
+        reps = min(reps, QUICK_REPS)
+
+    metrics = None
+    if metrics_file is not None or metrics_port is not None:
+        from .metrics import Metrics
+        metrics = Metrics(filename=metrics_file, port=metrics_port)
+        for cam in cameras:
+            for N in nsky_list:
+                for M in range(reps):
+                    metrics.register('stats', (cam, N, M))
 
-    filename = jsondir + '/data-{}-{:08d}.json'.format(night, expid)
     data = dict()
-    for cam in cameras:
-        data[cam] = write_rms_dict(night, expid, cam, basedir, nsky_list, wave_filters[cam], reps=reps)
+    residuals = dict()
+    try:
+        for cam in cameras:
+            residuals[cam] = dict() if cube else None
+            data[cam] = write_rms_dict(night, expid, cam, basedir, nsky_list, wave_filters[cam], reps=reps, 
+                                       residuals=residuals[cam], quick=quick, storage=storage, metrics=metrics)
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+    if cube:
+        save_residual_cube(night, expid, residuals, nsky_list, reps, jsondir)
+    save_rms_curve(night, expid, data, nsky_list, jsondir, quick=quick)
+    
+    return save_data_json(night, expid, data, jsondir, dbfile=dbfile)
+
+def save_residual_cube(night, expid, residuals, nsky_list, reps, jsondir, wave_bins=None):
+    '''Writes the per-wavelength residuals {camera: {(nsky, rep): residuals}} of get_cell_stats() as a 
+    (nsky, rep, wavelength bin) cube per camera to jsondir/cube-{night}-{expid}.npz. The file holds 'wave_bins',
+    'nsky_list' and, for each camera, float32 arrays '{camera}_mean', '{camera}_rms', '{camera}_chi2' and
+    '{camera}_npix', NaN for models without results. Returns the filename.'''
+    if wave_bins is None:
+        wave_bins = WAVE_BINS
+    nbins = len(wave_bins) - 1
+    arrays = dict(wave_bins=wave_bins, nsky_list=np.array(nsky_list))
+    for cam, cam_residuals in residuals.items():
+        for key in ('mean', 'rms', 'chi2', 'npix'):
+            cube = np.full((len(nsky_list), reps, nbins), np.nan, dtype=np.float32)
+            for i, n in enumerate(nsky_list):
+                for N in range(reps):
+                    if (n, N) in cam_residuals:
+                        cube[i, N] = cam_residuals[(n, N)][key]
+            arrays['{}_{}'.format(cam, key)] = cube
+
+    filename = jsondir + '/cube-{}-{:08d}.npz'.format(night, expid)
+    np.savez_compressed(filename, **arrays)
+    print('wrote {}'.format(filename))
+    return filename
+
+def save_data_json(night, expid, data, jsondir, dbfile=None):
+    '''Writes data {camera: {nsky: {rep: fiber_dict}}} to jsondir/data-{night}-{expid}.json, 
+    and ingests it into the results database dbfile if given. Returns the json filename.'''
     
+    import json
+
+    filename = jsondir + '/data-{}-{:08d}.json'.format(night, expid)
     with open(filename, 'w') as outfile:
         json.dump(data, outfile)
         
     print ('wrote {}'.format(filename))
 
+    if dbfile is not None:
+        from . import db
+        db.ingest_json(dbfile, filename)
+    return filename
+
 def get_wave_filters(night, expid, cameras):
     wave_filters = dict()
     for cam in cameras:
-        skyfile = desispec.io.findfile('sky', night, expid, camera=cam)
-        sky = desispec.io.read_sky(skyfile)
-        if cam == 'r3':
+        sky = read_exposure_sky(night, expid, cam)
+        #- same range for the cameras of an arm on every petal
+        if cam[0] == 'r':
             wave_filters[cam] = (5500 < sky.wave) & (sky.wave < 8000)
-        if cam == 'b3':
+        if cam[0] == 'b':
             wave_filters[cam] = (5000 < sky.wave) & (sky.wave < 6000)
-        if cam == 'z3':
+        if cam[0] == 'z':
             wave_filters[cam] = (7500 < sky.wave) & (sky.wave < 9900)
     return wave_filters
 
 def plot_rms_mean_scatter(file, cam, basedir, nsky_list, wave_filter, title=None, reps=None):
 
     import json
-    colors = {'r3': 'red', 'b3': 'blue', 'z3': 'black'}
-    scales = {'r3': {'min':50, 'max':250}, 'b3': {'min':50, 'max':200}, 'z3': {'min':50, 'max':250}}
+    #- by arm, the same for the cameras of all petals
+    colors = {'r': 'red', 'b': 'blue', 'z': 'black'}
+    scales = {'r': {'min':50, 'max':250}, 'b': {'min':50, 'max':200}, 'z': {'min':50, 'max':250}}
+    arm = cam[0]
     if reps == None:
         reps = 5
     
@@ -243,14 +659,19 @@ def plot_rms_mean_scatter(file, cam, basedir, nsky_list, wave_filter, title=None
     with open(file) as json_file:
         data = json.load(json_file)
      
-    cam_data = data[cam]
+    cam_data = data.get(cam, dict())
     
     rms_data = []
     nsky_data = []
+    nsky_line = []
     line_avg = []
     line_std = []
     for nsky in nsky_list:
-        n_data = cam_data[str(nsky)]
+        #- models that failed have no results
+        n_data = cam_data.get(str(nsky), dict())
+        if len(n_data) == 0:
+            continue
+        nsky_line.append(nsky)
         line = []
         for key in n_data.keys():
             fiber_data = np.array((n_data[key]['fiber_RMS']))
@@ -266,32 +687,169 @@ def plot_rms_mean_scatter(file, cam, basedir, nsky_list, wave_filter, title=None
     })
     
     source1 = ColumnDataSource(data = {
-        'nsky' : nsky_list,
+        'nsky' : nsky_line,
         'line_std': line_std,
         'line_avg': line_avg,
     })
     
-    if np.max(rms_data) >= scales[cam]['min']:
-        y_range = scales[cam]['max']
+    if len(rms_data) > 0 and np.max(rms_data) >= scales[arm]['min']:
+        y_range = scales[arm]['max']
     else:
-        y_range = scales[cam]['min']
+        y_range = scales[arm]['min']
     
     fig = bk.figure(title='Model Quality vs. Number of Fibers', width=350, height=350, y_range=(0, y_range))
-    fig.circle('nsky_data', 'rms_data', source=source, color=colors[cam], alpha=0.65, size=5, legend="per-realization")
-    fig.line('nsky', 'line_avg', source=source1, color=colors[cam], alpha=1, legend='mean')
+    fig.circle('nsky_data', 'rms_data', source=source, color=colors[arm], alpha=0.65, size=5, legend="per-realization")
+    fig.line('nsky', 'line_avg', source=source1, color=colors[arm], alpha=1, legend='mean')
     fig.xaxis.axis_label = 'Number of Sky Fibers Used in Model'
     fig.yaxis.axis_label = 'Q for non-model fibers'
     #fig.legend
     
-    y_range1 = max(2.5, np.max(line_std))
+    y_range1 = max([2.5,] + line_std)
     fig1 = bk.figure(title='Standard deviation across realizations', width=350, height=350, y_range=(0, 1.05*y_range1))
-    fig1.circle('nsky', 'line_std', source=source1, color=colors[cam], alpha=1)
+    fig1.circle('nsky', 'line_std', source=source1, color=colors[arm], alpha=1)
     fig1.xaxis.axis_label = 'Number of Sky Fibers Used in Model'
     fig1.yaxis.axis_label = 'Standard deviation'
     
     return [fig, fig1]
 
-def run_analysis(night, expid, cameras, basedir, nsky_list, reps=5):
+def get_frame_shape(framefile):
+    '''Returns (nspec, nwave, ndiag) of a frame file from its headers, without reading the data'''
+    fluxhdr = fitsio.read_header(framefile, 'FLUX')
+    reshdr = fitsio.read_header(framefile, 'RESOLUTION')
+    return fluxhdr['NAXIS2'], fluxhdr['NAXIS1'], reshdr['NAXIS2']
+
+def estimate_task_memory(stage, nspec, nwave, ndiag, sky_format='full', narms=1):
+    '''Returns the estimated peak memory in bytes of an analysis stage ('frame', 'sky', 'sframe' or 'stats')
+    for a frame of nspec fibers, nwave wavelengths and ndiag resolution diagonals.
+    These are rough upper bounds from the arrays each stage holds at once: the frame (flux, ivar, mask and
+    resolution data plus the sparse resolution matrices built from it), copies of it, fiberflats, sky models
+    and the dense (nwave x nwave) matrices of the sky fit.'''
+    image = nspec*nwave*(8 + 8 + 4)
+    frame = image + 2*nspec*ndiag*nwave*8
+    if stage == 'frame':
+        #- frame, its deepcopy in get_sky_candidates() and the fiberflat, for each arm of a petal
+        return narms*(2*frame + image)
+    elif stage == 'sky':
+        #- frame, fiberflat, normal matrix and its inverse, per-fiber sky model
+        return frame + 2*image + 2*nwave*nwave*8
+    elif stage == 'sframe':
+        #- frame, fiberflat and per-fiber sky, plus for compact sky models the stacked resolution matrix
+        #- and a temporary of the same size (its absolute values for the mask)
+        compact = 2*nspec*ndiag*nwave*12 if sky_format == 'compact' else 0
+        return frame + 2*image + compact
+    elif stage == 'stats':
+        return frame + image
+    raise ValueError('unknown stage {}'.format(stage))
+
+def get_analysis_tasks(night, expid, cameras, basedir, nsky_list, reps=5, wave_filters=None, by_petal=False, sky_format='full',
+                       skip_existing=False, quick=False, estimate_memory=False, storage='fits'):
+    '''Returns the list of skysub.scheduler.Task generating the frame, sky, sframe (and, if wave_filters 
+    is given, statistics) of every model, see run_analysis(). Each model only depends on its own inputs, 
+    e.g. the sky task of a model waits for its frame file but not for the frame files of other models.
+    With skip_existing, models whose frame and sframe files already exist only get a statistics task.
+    With quick, the statistics use a subsample of fibers and wavelengths, see get_cell_stats().
+    With estimate_memory, the peak memory of each task is estimated from the shapes of the input frames,
+    see estimate_task_memory(). storage is 'fits' or 'hdf5', see skysub.storage.'''
+    from .scheduler import Task
+
+    shapes = dict()
+    def memory(stage, cams):
+        if not estimate_memory:
+            return 0
+        for cam in cams:
+            if cam not in shapes:
+                shapes[cam] = get_frame_shape(get_input_files(night, expid, cam)[0])
+        nspec, nwave, ndiag = np.max([shapes[cam] for cam in cams], axis=0)
+        return estimate_task_memory(stage, nspec, nwave, ndiag, sky_format=sky_format, narms=len(cams))
+
+    existing = products.list_products(basedir, expid, storage=storage) if skip_existing else set()
+    def exists(cam, n, N):
+        return skip_existing and all(get_cell_filename(kind, cam, expid, n, N, basedir, storage=storage) in existing
+                                     for kind in ('frame', 'sframe'))
+
+    tasks = []
+    petal_tasks = dict()
+    if by_petal:
+        #- the sky fibers of all the models of a petal are drawn once, then each model writes the frames of
+        #- its arms in its own task, so that its sky models do not wait for the frames of the other models
+        for petal, petal_cameras in get_petal_cameras(cameras).items():
+            arms = [cam[0] for cam in petal_cameras]
+            cells = [(n, N) for N in range(reps) for n in nsky_list 
+                     if not all(exists(cam, n, N) for cam in petal_cameras)]
+            if len(cells) == 0:
+                continue
+            select_task = Task('select-petal{}'.format(petal), select_petal_sky_fibers, 
+                               args=(night, expid, petal, cells), kwargs=dict(arms=arms),
+                               stage='select', memory=memory('frame', petal_cameras))
+            tasks.append(select_task)
+            for n, N in cells:
+                petal_tasks[(petal, n, N)] = Task('frame-petal{}-{}-{}'.format(petal, n, N), write_selected_petal_frames,
+                                                  args=(select_task, night, expid, petal, basedir, n, N),
+                                                  kwargs=dict(arms=arms, storage=storage), deps=[select_task], 
+                                                  stage='frame', memory=memory('frame', petal_cameras))
+                tasks.append(petal_tasks[(petal, n, N)])
+
+    stats_kwargs = dict(wave_bins=WAVE_BINS)
+    if quick:
+        stats_kwargs.update(nfiber=QUICK_NFIBER, wave_step=QUICK_WAVE_STEP)
+
+    for cam in cameras:
+        for N in range(reps):
+            for n in nsky_list:
+                cell = (night, expid, cam, basedir, n, N)
+                deps = []
+                if by_petal:
+                    skip = (cam[1:], n, N) not in petal_tasks
+                else:
+                    skip = exists(cam, n, N)
+                if not skip:
+                    if by_petal:
+                        frame_task = petal_tasks[(cam[1:], n, N)]
+                    else:
+                        frame_task = Task('frame-{}-{}-{}'.format(cam, n, N), get_new_frame, 
+                                          args=(night, expid, cam, basedir, n), kwargs=dict(rep=N, storage=storage), stage='frame', cell=(cam, n, N),
+                                          memory=memory('frame', [cam,]))
+                        tasks.append(frame_task)
+                    sky_task = Task('sky-{}-{}-{}'.format(cam, n, N), compute_sky, args=cell, 
+                                    kwargs=dict(check=True, sky_format=sky_format, storage=storage), deps=[frame_task], stage='sky', cell=(cam, n, N),
+                                    memory=memory('sky', [cam,]))
+                    sframe_task = Task('sframe-{}-{}-{}'.format(cam, n, N), subtract_sky_cell, args=cell, 
+                                       kwargs=dict(sky_format=sky_format, storage=storage), deps=[sky_task], stage='sframe', cell=(cam, n, N),
+                                       memory=memory('sframe', [cam,]))
+                    tasks.extend([sky_task, sframe_task])
+                    deps = [sframe_task]
+                if wave_filters is not None:
+                    sframefile = get_cell_filename('sframe', cam, expid, n, N, basedir, storage=storage)
+                    stats_task = Task('stats-{}-{}-{}'.format(cam, n, N), get_cell_stats, 
+                                      args=(sframefile, wave_filters[cam]), kwargs=stats_kwargs,
+                                      deps=deps, stage='stats', cell=(cam, n, N), memory=memory('stats', [cam,]))
+                    tasks.append(stats_task)
+    return tasks
+
+def write_selected_petal_frames(select_task, night, expid, petal, basedir, nsky, rep, arms=('b', 'r', 'z'), storage='fits'):
+    '''Runs write_petal_frames() for one model with the sky fibers drawn by select_task, the finished
+    select_petal_sky_fibers() task of the petal in get_analysis_tasks()'''
+    iisky, selections = select_task.result
+    write_petal_frames(night, expid, petal, basedir, nsky, rep, iisky, selections[(nsky, rep)], arms=arms, storage=storage)
+
+def get_stats_dict(tasks, cameras, nsky_list, residuals=None):
+    '''Returns dict {camera: {nsky: {rep: fiber_dict}}} from the finished statistics tasks of get_analysis_tasks(), 
+    in the format of write_rms_dict(): every camera and nsky of the grid has an entry, empty if all of its 
+    models failed. If residuals is a dict, the per-wavelength residuals of each model are 
+    stored in it as {camera: {(nsky, rep): residuals}}, see save_residual_cube().'''
+    data = dict((cam, dict((n, dict()) for n in nsky_list)) for cam in cameras)
+    for task in tasks:
+        if task.stage == 'stats' and task.state == 'done':
+            cam, n, N = task.cell
+            fiber_dict, cell_residuals = task.result
+            data[cam][n][N] = fiber_dict
+            if residuals is not None:
+                residuals.setdefault(cam, dict())[(n, N)] = cell_residuals
+    return data
+
+def run_analysis(night, expid, cameras, basedir, nsky_list, reps=5, by_petal=False, wave_filters=None, nproc=1, retries=0,
+                 scratchdir=None, sky_format='full', shared=False, residuals=None, skip_existing=False, quick=False,
+                 max_memory=None, storage='fits', metrics_file=None, metrics_port=None):
     '''Generates all new files (frame, sky, and subtracted frame) for a given exposure on a given night, for a given set of cameras.
     Arguments:
         night: 
@@ -301,11 +859,89 @@ def run_analysis(night, expid, cameras, basedir, nsky_list, reps=5):
         nsky_list:
     Options:
         reps:
-    Writes all files to given base directory.'''
-    
-    get_new_frame_set(night, expid, cameras, basedir, nsky_list, reps=reps)
-    run_compute_sky(night, expid, cameras, basedir, nsky_list, reps=reps)
-    run_sky_subtraction(night, expid, cameras, basedir, nsky_list, reps=reps)
+        by_petal: share sky fiber selections between the arms of a petal, see get_new_frame_set()
+        wave_filters: dict of wavelength filters per camera; if given, the statistics of each model are 
+            also computed as soon as its sframe is written, see get_cell_stats()
+        nproc: number of stages run concurrently. Stages of a model start as soon as their inputs exist,
+            without waiting for the other models, see skysub.scheduler.run_tasks()
+        retries: number of times a failed stage is retried; stages depending on a failed one are skipped
+        scratchdir: node-local directory (e.g. $TMPDIR or /dev/shm); if given, the inputs are copied there 
+            before the run, all files are written there and copied to basedir in one bulk step at the end,
+            see skysub.staging. The local copies and outputs are removed afterwards
+        sky_format: 'full' or 'compact' sky model files, see run_compute_sky()
+        shared: if True, the frame, fiberflat and sky of each camera are read once per node into shared 
+            memory and used by all skysub processes of the node, see skysub.shm
+        residuals: if a dict and wave_filters is given, the per-wavelength residuals computed with the statistics
+            are stored in it, see get_stats_dict()
+        skip_existing: only compute statistics for models whose frame and sframe files already exist in 
+            basedir, e.g. to refine a quick-look run. With scratchdir, they are copied there first
+        quick: quick-look run on a reduced grid of models (get_quick_grid(), QUICK_REPS realizations), with
+            statistics from subsamples of fibers and wavelengths
+        max_memory: memory budget in bytes; stages are only started while the sum of their estimated peak 
+            memory stays within it, and stages killed for running out of memory are rescheduled alone;
+            only the sky fits run in child processes (see compute_sky()), an out-of-memory kill of the
+            other stages kills the whole run
+        storage: 'fits' writes one file per product, 'hdf5' all the products of the exposure into one 
+            container file, see skysub.storage
+        metrics_file: file to write live progress metrics of the tasks to (Prometheus text format), see skysub.metrics
+        metrics_port: local port to also serve these metrics on, at http://localhost:port/metrics
+    Writes all files to given base directory. Returns the statistics dict {camera: {nsky: {rep: fiber_dict}}}
+    if wave_filters is given.'''
+    from .scheduler import run_tasks
+
+    if quick:
+        nsky_list = get_quick_grid(nsky_list)
+        reps = min(reps, QUICK_REPS)
+
+    outdir = basedir
+    staged = []
+    try:
+        if scratchdir is not None:
+            from . import staging
+            staged = staging.stage_inputs(night, expid, cameras, scratchdir)
+            outdir = os.path.join(scratchdir, 'output-{:08d}'.format(expid))
+            os.makedirs(outdir, exist_ok=True)
+        if scratchdir is not None and skip_existing:
+            #- the products of earlier runs are in basedir, reuse them from the local output directory
+            existing = products.list_products(basedir, expid, storage=storage)
+            if storage == 'hdf5':
+                names = set(os.path.basename(products.split_path(path)[0]) for path in existing)
+            else:
+                names = [os.path.basename(path) for path in existing 
+                         if os.path.basename(path).split('-')[0] in ('frame', 'sframe')]
+            staging.fetch_outputs(basedir, outdir, names)
+        tasks = get_analysis_tasks(night, expid, cameras, outdir, nsky_list, reps=reps, wave_filters=wave_filters, 
+                                   by_petal=by_petal, sky_format=sky_format, skip_existing=skip_existing, quick=quick,
+                                   estimate_memory=max_memory is not None, storage=storage)
+        metrics = None
+        attached = []
+        try:
+            if metrics_file is not None or metrics_port is not None:
+                from .metrics import Metrics
+                metrics = Metrics(filename=metrics_file, port=metrics_port)
+            if shared:
+                for cam in cameras:
+                    shm.attach(night, expid, cam)
+                    attached.append(cam)
+            summary = run_tasks(tasks, nproc=nproc, retries=retries, max_memory=max_memory, metrics=metrics)
+        finally:
+            #- only the stores attached before a failure, the other cameras hold no reference of this process
+            for cam in attached:
+                shm.detach(night, expid, cam)
+            if metrics is not None:
+                metrics.close()
+        print('{done} tasks done, {failed} failed, {skipped} skipped'.format(**summary))
+
+        if scratchdir is not None:
+            staging.flush_outputs(outdir, basedir)
+            #- only once everything was copied, node-local space (e.g. /dev/shm) is scarce
+            shutil.rmtree(outdir)
+    finally:
+        if scratchdir is not None:
+            staging.unstage(staged, remove=True)
+
+    if wave_filters is not None:
+        return get_stats_dict(tasks, cameras, nsky_list, residuals=residuals)
     
 def plot_data(file, night, expid, cameras, basedir, nsky_list, wave_filters, reps=5):   
     '''Plots given file (must be json with correct data format)'''
@@ -321,28 +957,38 @@ def plot_data(file, night, expid, cameras, basedir, nsky_list, wave_filters, rep
         both_figs.append(row(cam_figs[i], cam_rms[i]))#cam_avgs[i], cam_rms[i]))
     return column(both_figs)
     
-def full_analysis(night, expid, cameras, basedir, json_dir, nsky_list, reps=5):
-    
-    run_analysis(night, expid, cameras, basedir, nsky_list, reps=reps)
+def full_analysis(night, expid, cameras, basedir, json_dir, nsky_list, reps=5, by_petal=False, nproc=1, retries=0,
+                  scratchdir=None, sky_format='full', shared=False, skip_existing=False, quick=False, max_memory=None,
+                  storage='fits', dbfile=None, metrics_file=None, metrics_port=None):
     
+    if quick:
+        nsky_list = get_quick_grid(nsky_list)
+        reps = min(reps, QUICK_REPS)
     wave_filters = get_wave_filters(night, expid, cameras)
-    write_dict_to_json(night, expid, cameras, basedir, json_dir, nsky_list, wave_filters, reps=reps)
-    file = basedir + '/data-{}-{:08d}.json'.format(night, expid)
-    
-    cam_fig = plot_data(file, cameras, basedir, nsky_list, wave_filters, reps=reps)
+    residuals = dict()
+    data = run_analysis(night, expid, cameras, basedir, nsky_list, reps=reps, by_petal=by_petal,
+                        wave_filters=wave_filters, nproc=nproc, retries=retries, scratchdir=scratchdir,
+                        sky_format=sky_format, shared=shared, residuals=residuals, skip_existing=skip_existing,
+                        quick=quick, max_memory=max_memory, storage=storage, metrics_file=metrics_file,
+                        metrics_port=metrics_port)
+    save_residual_cube(night, expid, residuals, nsky_list, reps, json_dir)
+    save_rms_curve(night, expid, data, nsky_list, json_dir, quick=quick)
+    file = save_data_json(night, expid, data, json_dir, dbfile=dbfile)
+    
+    cam_fig = plot_data(file, night, expid, cameras, basedir, nsky_list, wave_filters, reps=reps)
     return cam_fig
     
-def plot_unsubtracted_sky(night, expid, cam, nsky, rep, basedir, wave_filter, title, height=200, width=200):
+def plot_unsubtracted_sky(night, expid, cam, nsky, rep, basedir, wave_filter, title, height=200, width=200, storage='fits'):
     
-    frame = desispec.io.read_frame(basedir + '/frame-{cam}-{expid:08d}-{nsky}-{rep}.fits'.format(cam=cam, expid=expid, nsky=nsky, rep=rep))
+    frame = products.read_frame(get_cell_filename('frame', cam, expid, nsky, rep, basedir, storage=storage))
     fig = bk.figure(width=width, height=height, title=title)
     for i in np.where(frame.fibermap['OBJTYPE'] == 'TGT')[0]:
         fig.line(frame.wave[wave_filter], frame.flux[i][wave_filter], alpha=0.5)
     return fig
 
-def plot_subtracted_sky(night, expid, cam, nsky, rep, basedir, wave_filter, title, height=200, width=200):
+def plot_subtracted_sky(night, expid, cam, nsky, rep, basedir, wave_filter, title, height=200, width=200, storage='fits'):
     
-    sframe = desispec.io.read_frame(basedir + '/sframe-{cam}-{expid:08d}-{nsky}-{rep}.fits'.format(cam=cam, expid=expid, nsky=nsky, rep=rep))
+    sframe = products.read_frame(get_cell_filename('sframe', cam, expid, nsky, rep, basedir, storage=storage))
     fig = bk.figure(width=width, height=height, title=title)
     for i in np.where(sframe.fibermap['OBJTYPE'] == 'TGT')[0]:
         fig.line(sframe.wave[wave_filter], sframe.flux[i][wave_filter], alpha=0.5)
@@ -0,0 +1,157 @@
+"""
+Dependency-aware scheduling of the frame -> sky -> sframe -> stats stages of each model
+"""
+
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class Task(object):
+    '''A unit of work run by run_tasks() once all the tasks in deps are done.
+    Args:
+        name: unique name of the task, example 'sky-r3-50-0'
+        func: function to call, func(*args, **kwargs)
+    Options:
+        args, kwargs: arguments to func
+        deps: list of Task that must be done before this one starts
+        stage: name of the pipeline stage this task belongs to (frame, sky, sframe or stats)
+        cell: (camera, nsky, rep) of the model this task belongs to, if any
+        memory: estimated peak memory of the task in bytes, used by run_tasks() with max_memory
+    After run_tasks(), state is one of 'done', 'failed' or 'skipped' (a dependency failed or
+    was skipped), result holds the return value of func and error the last traceback.'''
+
+    def __init__(self, name, func, args=(), kwargs=None, deps=(), stage=None, cell=None, memory=0):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = dict() if kwargs is None else kwargs
+        self.deps = list(deps)
+        self.stage = stage
+        self.cell = cell
+        self.memory = memory
+        #- set after the task ran out of memory, so that it is run alone
+        self.exclusive = False
+        self.state = 'pending'
+        self.attempts = 0
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return 'Task({}, {})'.format(self.name, self.state)
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+def run_tasks(tasks, nproc=1, retries=0, max_memory=None, oom_retries=3, metrics=None):
+    '''Runs a list of tasks, starting each one as soon as its dependencies are done.
+    Args:
+        tasks: list of Task; when several tasks are ready they are started in list order
+    Options:
+        nproc: number of tasks run concurrently (threads), default 1
+        retries: number of times a failed task is retried before it is marked failed, default 0
+        max_memory: memory budget in bytes; a ready task is only started while the estimated memory of
+            the running tasks plus its own stays within the budget (a task is always started if nothing
+            else is running). Default None, no limit
+        oom_retries: number of times a task that ran out of memory (MemoryError) is rescheduled, alone,
+            in addition to retries. Default 3
+        metrics: skysub.metrics.Metrics to report the start and end of every task to, and to update
+            while tasks are running
+    Descendants of a failed task are marked skipped instead of being run.
+    Returns dict with the number of tasks in each final state.'''
+
+    pending = list(tasks)
+    running = dict()
+    oom_count = dict()
+    start_time = dict()
+    if metrics is not None:
+        for task in tasks:
+            metrics.register(task.stage, task.cell)
+
+    def report(task, state):
+        if metrics is not None:
+            seconds = time.time() - start_time[task.name] if task.name in start_time else None
+            metrics.finished(task.stage, seconds, state, task.cell)
+
+    def fits(task):
+        if len(running) == 0:
+            return True
+        if task.exclusive or any(t.exclusive for t in running.values()):
+            return False
+        if max_memory is None:
+            return True
+        return sum(t.memory for t in running.values()) + task.memory <= max_memory
+
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            #- start every task whose dependencies are satisfied, in order, while they fit in memory
+            for task in list(pending):
+                if len(running) >= nproc:
+                    break
+                depstates = [dep.state for dep in task.deps]
+                if 'failed' in depstates or 'skipped' in depstates:
+                    task.state = 'skipped'
+                    pending.remove(task)
+                    report(task, 'skipped')
+                    print('SKIPPED {}'.format(task.name))
+                elif all(state == 'done' for state in depstates):
+                    if not fits(task):
+                        #- wait for memory to be released instead of starting smaller tasks
+                        #- after it, so that large tasks are not starved
+                        break
+                    task.state = 'running'
+                    task.attempts += 1
+                    pending.remove(task)
+                    start_time[task.name] = time.time()
+                    if metrics is not None:
+                        metrics.started(task.stage)
+                    running[pool.submit(task.run)] = task
+
+            if len(running) == 0:
+                #- only reachable if remaining tasks depend on tasks not in the list
+                for task in pending:
+                    task.state = 'skipped'
+                    report(task, 'skipped')
+                    print('SKIPPED {} (unmet dependencies)'.format(task.name))
+                break
+
+            if metrics is not None:
+                metrics.update()
+            #- with metrics, wake up regularly to keep them current while long tasks run
+            done, _ = wait(list(running), timeout=None if metrics is None else metrics.interval, 
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    task.result = future.result()
+                    task.state = 'done'
+                except MemoryError:
+                    task.error = traceback.format_exc()
+                    oom_count[task.name] = oom_count.get(task.name, 0) + 1
+                    if oom_count[task.name] <= oom_retries:
+                        print('RESCHEDULING {} to run alone after running out of memory'.format(task.name))
+                        task.attempts -= 1
+                        task.exclusive = True
+                        task.state = 'pending'
+                        pending.insert(0, task)
+                    else:
+                        print('FAILED {}:\n{}'.format(task.name, task.error))
+                        task.state = 'failed'
+                except Exception:
+                    task.error = traceback.format_exc()
+                    if task.attempts <= retries:
+                        print('RETRYING {} after error:\n{}'.format(task.name, task.error))
+                        task.state = 'pending'
+                        pending.insert(0, task)
+                    else:
+                        print('FAILED {}:\n{}'.format(task.name, task.error))
+                        task.state = 'failed'
+                report(task, 'retry' if task.state == 'pending' else task.state)
+                start_time.pop(task.name, None)
+
+    if metrics is not None:
+        metrics.update(force=True)
+
+    summary = dict(done=0, failed=0, skipped=0)
+    for task in tasks:
+        summary[task.state] = summary.get(task.state, 0) + 1
+    return summary
@@ -6,6 +6,8 @@ import os, sys, time, glob
 import argparse
 import traceback
 import subprocess
+import bokeh.plotting as bk
+from bokeh.layouts import row
 from . import run
 
 os.environ['DESI_SPECTRO_REDUX'] = '/project/projectdirs/desi/spectro/redux'
@@ -20,10 +22,21 @@ Supported commands are:
     json     Generate json file with subtraction quality data for given night, exposure
     plot     Given a pregenerated json file, generate plots
     skyplot  Given a set of files, plot unsubtracted vs. subtracted sky spectra
+    query    Ingest json files into a results database and query RMS vs. number of sky fibers
+    serve-plots  Interactive local viewer of unsubtracted vs. subtracted sky spectra for all models
+    watch    Watch the redux exposures tree and run the full analysis of each new exposure
     
 Run "skysub <command> --help" for detailed options about each command
 """)
     
+def parse_size(size):
+    '''Returns the number of bytes of a size like 16GB, 512M or 1000000'''
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+    
 def main():
     if len(sys.argv) == 1 or sys.argv[1] in ('-h', '--help', '-help', 'help'):
         print_help()
@@ -32,7 +45,7 @@ def main():
     command = sys.argv[1]
     if command == 'full':
         main_full()
-    if command == 'run':
+    elif command == 'run':
         main_run()
     elif command == 'json':
         main_json()
@@ -40,6 +53,12 @@ def main():
         main_plot()
     elif command == 'skyplot':
         main_skyplot()
+    elif command == 'query':
+        main_query()
+    elif command == 'serve-plots':
+        main_serve_plots()
+    elif command == 'watch':
+        main_watch()
     else:
         print('ERROR: unrecognized command "{}"'.format(command))
         print_help()
@@ -51,17 +70,30 @@ def main_full(options=None):
     parser.add_argument("-e", "--expid", type=int,  help="exposure to analyze, expid without padding zeroes")
     parser.add_argument("-c", "--cameras", nargs='*', type=str, help="comma separated list of cameras, ex. --cameras r3 b3 z3")
     parser.add_argument("-bdir", "--basedir", type=str, help="directory to write output frame, sky, sframe files")
-    parser.add_argument("odir", "--outdir", type=str, help="directory to write plots (HTML files) ")
-    parser.add_argument("--nsky_list", nargs='*', type=int, default="1 2 5 10 20 30 40 50 60 70 80", help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
+    parser.add_argument("-odir", "--outdir", type=str, help="directory to write plots (HTML files) ")
+    parser.add_argument("--db", type=str, default=None, help="results database (sqlite) to also ingest the results into")
+    parser.add_argument("--nsky_list", nargs='*', type=int, default=[1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80], help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
     parser.add_argument("-r", "--reps", type=int, default=5, help="number of realizations for each model (default 5)")
+    parser.add_argument("--by-petal", action="store_true", help="share sky fiber selections between the b/r/z arms of a petal, drawn once per petal")
+    parser.add_argument("--nproc", type=int, default=1, help="number of frame/sky/sframe tasks to run concurrently (default 1)")
+    parser.add_argument("--retries", type=int, default=0, help="number of times to retry a failed task (default 0)")
+    parser.add_argument("--scratchdir", type=str, default=None, help="node-local directory to stage inputs and write outputs to before copying them to basedir")
+    parser.add_argument("--sky-format", choices=['full', 'compact'], default='full', help="write per-fiber sky models (full, default) or only the deconvolved sky spectrum (compact)")
+    parser.add_argument("--shared", action="store_true", help="share the input frame/fiberflat/sky arrays with other skysub processes on this node through /dev/shm")
+    parser.add_argument("--skip-existing", action="store_true", help="reuse models whose frame and sframe files already exist (e.g. from a --quick run)")
+    parser.add_argument("--quick", action="store_true", help="quick-look run on a reduced grid of models, with statistics from subsampled fibers and wavelengths")
+    parser.add_argument("--storage", choices=['fits', 'hdf5'], default='fits', help="write one FITS file per product (fits, default) or one container file per exposure (hdf5)")
+    parser.add_argument("--metrics-file", type=str, default=None, help="file to write live progress metrics to, in Prometheus text format")
+    parser.add_argument("--metrics-port", type=int, default=None, help="local port to serve live progress metrics on, at http://localhost:PORT/metrics")
+    parser.add_argument("--max-memory", type=parse_size, default=None, help="memory budget for concurrent tasks, ex. 16GB (default no limit)")
 
     if options is None:
         options = sys.argv[2:]
 
     args = parser.parse_args(options)
     
-    cam_fig = run.full_analysis(args.night, args.expid, args.cameras, args.basedir, args.basedir, args.nsky_list, reps=args.reps)
-    bk.output_file(outdir + 'cam_plots-{}-{:08d}.html'.format(night, expid))
+    cam_fig = run.full_analysis(args.night, args.expid, args.cameras, args.basedir, args.basedir, args.nsky_list, reps=args.reps, by_petal=args.by_petal, nproc=args.nproc, retries=args.retries, scratchdir=args.scratchdir, sky_format=args.sky_format, shared=args.shared, skip_existing=args.skip_existing, quick=args.quick, max_memory=args.max_memory, storage=args.storage, metrics_file=args.metrics_file, metrics_port=args.metrics_port, dbfile=args.db)
+    bk.output_file(args.outdir + '/cam_plots-{}-{:08d}.html'.format(args.night, args.expid))
     bk.save(cam_fig)
     
 def main_run(options=None):
@@ -70,15 +102,27 @@ def main_run(options=None):
     parser.add_argument("-e", "--expid", type=int,  help="exposure to analyze, expid without padding zeroes")
     parser.add_argument("-c", "--cameras", nargs='*', type=str, help="comma separated list of cameras, ex. --cameras r3 b3 z3")
     parser.add_argument("-bdir", "--basedir", type=str, help="directory to write output files")
-    parser.add_argument("--nsky_list", nargs='*', type=int, default="1 2 5 10 20 30 40 50 60 70 80", help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
+    parser.add_argument("--nsky_list", nargs='*', type=int, default=[1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80], help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
     parser.add_argument("-r", "--reps", type=int, default=5, help="number of realizations for each model (default 5)")
+    parser.add_argument("--by-petal", action="store_true", help="share sky fiber selections between the b/r/z arms of a petal, drawn once per petal")
+    parser.add_argument("--nproc", type=int, default=1, help="number of frame/sky/sframe tasks to run concurrently (default 1)")
+    parser.add_argument("--retries", type=int, default=0, help="number of times to retry a failed task (default 0)")
+    parser.add_argument("--scratchdir", type=str, default=None, help="node-local directory to stage inputs and write outputs to before copying them to basedir")
+    parser.add_argument("--sky-format", choices=['full', 'compact'], default='full', help="write per-fiber sky models (full, default) or only the deconvolved sky spectrum (compact)")
+    parser.add_argument("--shared", action="store_true", help="share the input frame/fiberflat/sky arrays with other skysub processes on this node through /dev/shm")
+    parser.add_argument("--skip-existing", action="store_true", help="reuse models whose frame and sframe files already exist (e.g. from a --quick run)")
+    parser.add_argument("--quick", action="store_true", help="quick-look run on a reduced grid of models, with statistics from subsampled fibers and wavelengths")
+    parser.add_argument("--storage", choices=['fits', 'hdf5'], default='fits', help="write one FITS file per product (fits, default) or one container file per exposure (hdf5)")
+    parser.add_argument("--metrics-file", type=str, default=None, help="file to write live progress metrics to, in Prometheus text format")
+    parser.add_argument("--metrics-port", type=int, default=None, help="local port to serve live progress metrics on, at http://localhost:PORT/metrics")
+    parser.add_argument("--max-memory", type=parse_size, default=None, help="memory budget for concurrent tasks, ex. 16GB (default no limit)")
 
     if options is None:
         options = sys.argv[2:]
 
     args = parser.parse_args(options)
     
-    run.run_analysis(args.night, args.expid, args.cameras, args.basedir, args.nsky_list, reps=args.reps)
+    run.run_analysis(args.night, args.expid, args.cameras, args.basedir, args.nsky_list, reps=args.reps, by_petal=args.by_petal, nproc=args.nproc, retries=args.retries, scratchdir=args.scratchdir, sky_format=args.sky_format, shared=args.shared, skip_existing=args.skip_existing, quick=args.quick, max_memory=args.max_memory, storage=args.storage, metrics_file=args.metrics_file, metrics_port=args.metrics_port)
     
 def main_json(options=None):
     parser = argparse.ArgumentParser(usage = "{prog} run [options]")
@@ -87,8 +131,14 @@ def main_json(options=None):
     parser.add_argument("-c", "--cameras", nargs='*', type=str, help="comma separated list of cameras, ex. --cameras r3 b3 z3")
     parser.add_argument("--basedir", type=str, help="where to look for frame, sky, sframe files")
     parser.add_argument("--jsondir", type=str, help="directory to write output files")
-    parser.add_argument("--nsky_list", nargs='*', type=int, default="1 2 5 10 20 30 40 50 60 70 80", help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
+    parser.add_argument("--nsky_list", nargs='*', type=int, default=[1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80], help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
     parser.add_argument("--reps", type=int, default=5, help="number of realizations for each model (default 5)")
+    parser.add_argument("--db", type=str, default=None, help="results database (sqlite) to also ingest the results into")
+    parser.add_argument("--no-cube", action="store_true", help="do not write the per-wavelength residual cube (cube-{night}-{expid}.npz)")
+    parser.add_argument("--quick", action="store_true", help="quick-look statistics on a reduced grid of models with subsampled fibers and wavelengths")
+    parser.add_argument("--storage", choices=['fits', 'hdf5'], default='fits', help="write one FITS file per product (fits, default) or one container file per exposure (hdf5)")
+    parser.add_argument("--metrics-file", type=str, default=None, help="file to write live progress metrics to, in Prometheus text format")
+    parser.add_argument("--metrics-port", type=int, default=None, help="local port to serve live progress metrics on, at http://localhost:PORT/metrics")
 
     if options is None:
         options = sys.argv[2:]
@@ -97,7 +147,7 @@ def main_json(options=None):
     
     wave_filters = run.get_wave_filters(args.night, args.expid, args.cameras)
     
-    run.write_dict_to_json(args.night, args.expid, args.cameras, args.basedir, args.jsondir, args.nsky_list, wave_filters, reps=args.reps)
+    run.write_dict_to_json(args.night, args.expid, args.cameras, args.basedir, args.jsondir, args.nsky_list, wave_filters, reps=args.reps, dbfile=args.db, cube=not args.no_cube, quick=args.quick, storage=args.storage, metrics_file=args.metrics_file, metrics_port=args.metrics_port)
     
 def main_plot(options=None):
     parser = argparse.ArgumentParser(usage = "{prog} run [options]")
@@ -106,7 +156,7 @@ def main_plot(options=None):
     parser.add_argument("-c", "--cameras", nargs='*', type=str, help="comma separated list of cameras, ex. --cameras r3 b3 z3")
     parser.add_argument("--jsondir", type=str, help="where to look for json file with data to be plotted")
     parser.add_argument("--outdir", type=str, help="where to write output plot HTML files")
-    parser.add_argument("--nsky_list", nargs='*', type=int, default="1 2 5 10 20 30 40 50 60 70 80", help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
+    parser.add_argument("--nsky_list", nargs='*', type=int, default=[1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80], help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
     parser.add_argument("--reps", type=int, default=5, help="number of realizations for each model (default 5)")
 
     if options is None:
@@ -130,7 +180,8 @@ def main_skyplot(options=None):
     parser.add_argument("--rep", default=0, type=int, help="realization to use (for help locating right file)")
     parser.add_argument("--basedir", type=str, help="where to look for frame, sky, sframe files")
     parser.add_argument("--outdir", type=str, help="where to output skyplot HTML files")
-    parser.add_argument("--nsky_list", nargs='*', type=int, default="1 2 5 10 20 30 40 50 60 70 80", help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
+    parser.add_argument("--storage", choices=['fits', 'hdf5'], default='fits', help="storage the frame and sframe files were written with, one FITS file per product (fits, default) or one container file per exposure (hdf5)")
+    parser.add_argument("--nsky_list", nargs='*', type=int, default=[1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80], help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
     parser.add_argument("--reps", type=int, default=5, help="number of realizations for each model (default 5)")
 
     if options is None:
@@ -138,15 +189,98 @@ def main_skyplot(options=None):
 
     args = parser.parse_args(options)
     
-    wave_filters = run.get_wave_filters(args.night, args.expid, list(args.cam))
+    wave_filters = run.get_wave_filters(args.night, args.expid, [args.cam,])
     
-    fig1 = plot_unsubtracted_sky(args.night, args.expid, args.cam, args.nsky, args.rep, args.basedir, wave_filters[args.cam], 'Frame {}'.format(args.cam), height=350, width=400)
-    fig2 = plot_subtracted_sky(args.night, args.expid, args.cam, args.nsky, args.rep, args.basedir, wave_filters[args.cam], 'S-Frame'.format(args.cam), height=350, width=400)
+    fig1 = run.plot_unsubtracted_sky(args.night, args.expid, args.cam, args.nsky, args.rep, args.basedir, wave_filters[args.cam], 'Frame {}'.format(args.cam), height=350, width=400, storage=args.storage)
+    fig2 = run.plot_subtracted_sky(args.night, args.expid, args.cam, args.nsky, args.rep, args.basedir, wave_filters[args.cam], 'S-Frame {}'.format(args.cam), height=350, width=400, storage=args.storage)
     sky_fig = row([fig1, fig2])
     
     bk.output_file(args.outdir + "sky_plots-{}-{:08d}".format(args.night, args.expid))
     bk.save(sky_fig)
     
+def main_query(options=None):
+    from . import db
+    parser = argparse.ArgumentParser(usage = "{prog} query [options]")
+    parser.add_argument("--db", type=str, required=True, help="results database (sqlite), created if needed")
+    parser.add_argument("--ingest", nargs='*', type=str, default=[], help="json files or directories of data-*.json files to ingest first")
+    parser.add_argument("--force", action="store_true", help="re-ingest json files even if they did not change")
+    parser.add_argument("-n", "--night", nargs='*', type=int, help="nights to select YEARMMDD")
+    parser.add_argument("-e", "--expid", nargs='*', type=int, help="exposures to select, expid without padding zeroes")
+    parser.add_argument("-c", "--cameras", nargs='*', type=str, help="cameras to select, ex. --cameras r3 b3 z3")
+    parser.add_argument("--quick", action="store_true", help="use quick-look (subsampled) results instead of full results")
+
+    if options is None:
+        options = sys.argv[2:]
+
+    args = parser.parse_args(options)
+
+    if len(args.ingest) > 0:
+        count = db.ingest_paths(args.db, args.ingest, force=args.force)
+        print('ingested {} files into {}'.format(count, args.db))
+
+    cameras = args.cameras
+    if cameras is None:
+        cameras = sorted(set(db.query_realizations(args.db, night=args.night, expid=args.expid, quick=args.quick)['camera']))
+
+    for cam in cameras:
+        curve = db.query_rms_vs_nsky(args.db, camera=cam, night=args.night, expid=args.expid, quick=args.quick)
+        print('camera {}'.format(cam))
+        print('{:>6s} {:>10s} {:>10s} {:>6s}'.format('nsky', 'mean', 'std', 'nreal'))
+        for i in range(len(curve['nsky'])):
+            print('{:6d} {:10.3f} {:10.3f} {:6d}'.format(curve['nsky'][i], curve['mean'][i], curve['std'][i], curve['nreal'][i]))
+    
+def main_serve_plots(options=None):
+    from . import viewer
+    parser = argparse.ArgumentParser(usage = "{prog} serve-plots [options]")
+    parser.add_argument("--basedir", type=str, required=True, help="where to look for frame and sframe files")
+    parser.add_argument("--port", type=int, default=5006, help="local port to serve the viewer on (default 5006)")
+    parser.add_argument("--npix", type=int, default=1000, help="maximum number of points sent per spectrum (default 1000)")
+
+    if options is None:
+        options = sys.argv[2:]
+
+    args = parser.parse_args(options)
+
+    viewer.serve(args.basedir, port=args.port, npix=args.npix)
+    
+def main_watch(options=None):
+    from . import watch
+    parser = argparse.ArgumentParser(usage = "{prog} watch [options]")
+    parser.add_argument("-n", "--night", nargs='*', type=int, default=None, help="nights to watch YEARMMDD (default the most recent night)")
+    parser.add_argument("-c", "--cameras", nargs='*', type=str, default=None, help="cameras to analyze, ex. --cameras r3 b3 z3 (default all cameras with a frame; exposures are processed again when more cameras are ready)")
+    parser.add_argument("--reduxdir", type=str, default=None, help="redux production directory to watch (default $DESI_SPECTRO_REDUX/$SPECPROD)")
+    parser.add_argument("-bdir", "--basedir", type=str, required=True, help="directory to write output frame, sky, sframe files, in {night}/{expid} subdirectories")
+    parser.add_argument("--jsondir", type=str, required=True, help="directory to publish the json, curve and cube files to")
+    parser.add_argument("-odir", "--outdir", type=str, default=None, help="directory to publish plots (HTML files) to (default jsondir)")
+    parser.add_argument("--db", type=str, default=None, help="results database (sqlite) to also ingest the results into")
+    parser.add_argument("--nsky_list", nargs='*', type=int, default=[1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80], help="list of numbers of sky fibers to use for different models. ex. --nsky_list 1 2 3 4")
+    parser.add_argument("-r", "--reps", type=int, default=5, help="number of realizations for each model (default 5)")
+    parser.add_argument("--nworkers", type=int, default=1, help="number of exposures processed concurrently (default 1)")
+    parser.add_argument("--nproc", type=int, default=1, help="number of frame/sky/sframe tasks to run concurrently per exposure (default 1)")
+    parser.add_argument("--poll", type=float, default=30., help="seconds between scans of the exposures directories (default 30)")
+    parser.add_argument("--settle", type=float, default=60., help="seconds without changes before the inputs of an exposure are used (default 60)")
+    parser.add_argument("--once", action="store_true", help="process the exposures ready now and exit")
+    parser.add_argument("--by-petal", action="store_true", help="share sky fiber selections between the b/r/z arms of a petal, drawn once per petal")
+    parser.add_argument("--sky-format", choices=['full', 'compact'], default='full', help="write per-fiber sky models (full, default) or only the deconvolved sky spectrum (compact)")
+    parser.add_argument("--quick", action="store_true", help="quick-look run on a reduced grid of models, with statistics from subsampled fibers and wavelengths")
+    parser.add_argument("--storage", choices=['fits', 'hdf5'], default='fits', help="write one FITS file per product (fits, default) or one container file per exposure (hdf5)")
+    parser.add_argument("--max-memory", type=parse_size, default=None, help="memory budget for the concurrent tasks of an exposure, ex. 16GB (default no limit)")
+
+    if options is None:
+        options = sys.argv[2:]
+
+    args = parser.parse_args(options)
+
+    if args.reduxdir is not None:
+        #- desispec.io.findfile() locates the inputs from these
+        reduxdir = os.path.abspath(args.reduxdir)
+        os.environ['DESI_SPECTRO_REDUX'], os.environ['SPECPROD'] = os.path.split(reduxdir)
+
+    watch.watch(args.night, args.basedir, args.jsondir, args.nsky_list, cameras=args.cameras, outdir=args.outdir,
+                dbfile=args.db, nworkers=args.nworkers, poll=args.poll, settle=args.settle, once=args.once,
+                reps=args.reps, nproc=args.nproc, by_petal=args.by_petal, sky_format=args.sky_format, quick=args.quick,
+                storage=args.storage, max_memory=args.max_memory)
+    
 if __name__ == "__main__":
     main()
     
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""
+Node-local shared store of the base frame, fiberflat and sky arrays of an exposure
+
+The arrays are written once per (night, expid, camera) as .npy files in /dev/shm and memory-mapped
+read-only by every attached process, so concurrent skysub processes on a node share one copy.
+"""
+
+import os, json, fcntl
+from contextlib import contextmanager
+import numpy as np
+
+SHMDIR = '/dev/shm/skysub-{}'.format(os.getuid())
+
+#- (night, expid, camera) -> store directory, for the stores attached by this process
+_attached = dict()
+
+def _key(night, expid, camera):
+    return '{}-{:08d}-{}'.format(night, expid, camera)
+
+@contextmanager
+def _locked(shmdir, key):
+    #- lock files are never removed, so every process always locks the same inode
+    with open(os.path.join(shmdir, key + '.lock'), 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _read_refs(storedir):
+    filename = os.path.join(storedir, 'refs.json')
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as fx:
+        pids = json.load(fx)
+    #- drop processes that exited without detaching
+    return [pid for pid in pids if _pid_alive(pid)]
+
+def _write_refs(storedir, pids):
+    tmpfile = os.path.join(storedir, 'refs.json.tmp')
+    with open(tmpfile, 'w') as fx:
+        json.dump(pids, fx)
+    os.rename(tmpfile, os.path.join(storedir, 'refs.json'))
+
+def _save(storedir, name, array):
+    tmpfile = os.path.join(storedir, name + '.tmp.npy')
+    np.save(tmpfile, np.ascontiguousarray(array))
+    os.rename(tmpfile, os.path.join(storedir, name + '.npy'))
+
+def _populate(storedir, night, expid, camera):
+    '''Reads the frame, fiberflat and sky of a camera and writes their arrays to storedir'''
+    from astropy.table import Table
+    import desispec.io
+    from .run import get_input_files
+    from .staging import staged_path
+
+    framefile, fiberflatfile = get_input_files(night, expid, camera)
+    skyfile = staged_path(desispec.io.findfile('sky', night, expid, camera=camera))
+    frame = desispec.io.read_frame(framefile)
+    fiberflat = desispec.io.read_fiberflat(fiberflatfile)
+    sky = desispec.io.read_sky(skyfile)
+
+    _save(storedir, 'wave', frame.wave)
+    _save(storedir, 'flux', frame.flux)
+    _save(storedir, 'ivar', frame.ivar)
+    _save(storedir, 'mask', frame.mask)
+    _save(storedir, 'resolution', frame.resolution_data)
+    _save(storedir, 'fibermap', np.asarray(Table(frame.fibermap).as_array()))
+    _save(storedir, 'fiberflat', fiberflat.fiberflat)
+    _save(storedir, 'fiberflat_ivar', fiberflat.ivar)
+    _save(storedir, 'fiberflat_mask', fiberflat.mask)
+    _save(storedir, 'fiberflat_meanspec', fiberflat.meanspec)
+    _save(storedir, 'sky_flux', sky.flux)
+    _save(storedir, 'sky_ivar', sky.ivar)
+    _save(storedir, 'sky_mask', sky.mask)
+
+    meta = dict() if frame.meta is None else dict((key, frame.meta[key]) for key in frame.meta.keys())
+    info = dict(framefile=framefile, fiberflatfile=fiberflatfile, skyfile=skyfile, meta=meta)
+    with open(os.path.join(storedir, 'info.json'), 'w') as fx:
+        json.dump(info, fx, default=str)
+    #- written last: the store is complete once this exists
+    open(os.path.join(storedir, 'READY'), 'w').close()
+
+def attach(night, expid, camera, shmdir=None):
+    '''Attaches this process to the shared store of (night, expid, camera), loading the frame, fiberflat and
+    sky from disk if no other process did yet. Returns the store directory.
+    Attaching again from the same process is a no-op; call detach() when done.'''
+    if (night, expid, camera) in _attached:
+        return _attached[(night, expid, camera)]
+    if shmdir is None:
+        shmdir = SHMDIR
+    os.makedirs(shmdir, exist_ok=True)
+    key = _key(night, expid, camera)
+    storedir = os.path.join(shmdir, key)
+
+    with _locked(shmdir, key):
+        pids = _read_refs(storedir)
+        if not os.path.exists(os.path.join(storedir, 'READY')):
+            if os.path.isdir(storedir):
+                _remove(storedir)
+            os.makedirs(storedir)
+            print('loading {} into {}'.format(key, storedir))
+            try:
+                _populate(storedir, night, expid, camera)
+            except BaseException:
+                #- no process can use an incomplete store, do not leave it in /dev/shm
+                _remove(storedir)
+                raise
+        _write_refs(storedir, pids + [os.getpid(),])
+
+    _attached[(night, expid, camera)] = storedir
+    return storedir
+
+def _remove(storedir):
+    for name in os.listdir(storedir):
+        os.remove(os.path.join(storedir, name))
+    os.rmdir(storedir)
+
+def detach(night, expid, camera):
+    '''Detaches this process from the shared store of (night, expid, camera);
+    the store is removed when no live process is attached anymore'''
+    storedir = _attached.pop((night, expid, camera), None)
+    if storedir is None:
+        return
+    shmdir, key = os.path.split(storedir)
+    with _locked(shmdir, key):
+        pids = [pid for pid in _read_refs(storedir) if pid != os.getpid()]
+        if len(pids) == 0:
+            print('removing {}'.format(storedir))
+            _remove(storedir)
+        else:
+            _write_refs(storedir, pids)
+
+def is_attached(night, expid, camera):
+    return (night, expid, camera) in _attached
+
+def get_arrays(night, expid, camera):
+    '''Returns dict of read-only, zero-copy NumPy views of an attached store: wave, flux, ivar, mask,
+    resolution, fibermap, fiberflat, fiberflat_ivar, fiberflat_mask, fiberflat_meanspec, sky_flux,
+    sky_ivar and sky_mask'''
+    storedir = _attached[(night, expid, camera)]
+    arrays = dict()
+    for filename in os.listdir(storedir):
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]] = np.load(os.path.join(storedir, filename), mmap_mode='r')
+    return arrays
+
+def _get_info(night, expid, camera):
+    with open(os.path.join(_attached[(night, expid, camera)], 'info.json')) as fx:
+        return json.load(fx)
+
+def read_frame(night, expid, camera):
+    '''Returns a desispec Frame built on the shared arrays of an attached store.
+    flux, ivar and mask are read-only views; the fibermap is a private copy that can be modified.'''
+    from astropy.table import Table
+    from desispec.frame import Frame
+
+    arrays = get_arrays(night, expid, camera)
+    info = _get_info(night, expid, camera)
+    return Frame(arrays['wave'], arrays['flux'], arrays['ivar'], mask=arrays['mask'],
+                 resolution_data=arrays['resolution'], fibermap=Table(np.array(arrays['fibermap'])),
+                 meta=info['meta'])
+
+def read_fiberflat(night, expid, camera):
+    '''Returns a desispec FiberFlat built on the shared (read-only) arrays of an attached store'''
+    from desispec.fiberflat import FiberFlat
+
+    arrays = get_arrays(night, expid, camera)
+    return FiberFlat(arrays['wave'], arrays['fiberflat'], arrays['fiberflat_ivar'], mask=arrays['fiberflat_mask'],
+                     meanspec=arrays['fiberflat_meanspec'])
+
+def read_sky(night, expid, camera):
+    '''Returns a desispec SkyModel built on the shared (read-only) arrays of an attached store'''
+    from desispec.sky import SkyModel
+
+    arrays = get_arrays(night, expid, camera)
+    return SkyModel(arrays['wave'], arrays['sky_flux'], arrays['sky_ivar'], arrays['sky_mask'])
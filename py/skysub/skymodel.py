@@ -0,0 +1,159 @@
+"""
+Compact sky models: one deconvolved sky spectrum per model instead of a convolved sky per fiber
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import fitsio
+
+def fit_compact_sky(frame, nsig_clipping=4., max_iterations=100):
+    '''Fits the deconvolved sky spectrum common to the "SKY" fibers of a fiberflat-corrected frame.
+    This is the same uniform sky fit as desi_compute_sky --no-extra-variance, keeping the deconvolved
+    spectrum instead of convolving it with the resolution of every fiber.
+    Args:
+        frame: desispec Frame, with fiberflat already applied
+    Options:
+        nsig_clipping: outlier rejection threshold in sigma, default 4
+        max_iterations: maximum number of outlier rejection iterations, default 100
+    Returns (skyflux, skyivar, mask, covar) arrays on the frame wavelength grid. covar holds the band of the
+    covariance C of skyflux that resolution matrices can reach, covar[k, j] = C[j, j+k] for k < ndiag, 
+    which is all expand_sky() needs for the exact variance diag(R C R^T) of the sky of each fiber.'''
+
+    skyfibers = np.where(frame.fibermap['OBJTYPE'] == 'SKY')[0]
+    if len(skyfibers) == 0:
+        raise ValueError('no SKY fibers in frame')
+    nwave = frame.flux.shape[1]
+    flux = frame.flux[skyfibers]
+    weights = frame.ivar[skyfibers] * (frame.mask[skyfibers] == 0)
+    R = [frame.R[i] for i in skyfibers]
+
+    for iteration in range(max_iterations):
+        A = scipy.sparse.csr_matrix((nwave, nwave))
+        b = np.zeros(nwave)
+        for j in range(len(skyfibers)):
+            RtW = R[j].T.dot(scipy.sparse.diags(weights[j]))
+            A = A + RtW.dot(R[j])
+            b += RtW.dot(flux[j])
+
+        #- wavelengths without any weight are set to zero instead of making A singular
+        empty = (A.diagonal() == 0)
+        A = A + scipy.sparse.diags(empty.astype(float))
+        skyflux = scipy.sparse.linalg.spsolve(A.tocsc(), b)
+
+        nout = 0
+        for j in range(len(skyfibers)):
+            chi = (flux[j] - R[j].dot(skyflux)) * np.sqrt(weights[j])
+            bad = (np.abs(chi) > nsig_clipping) & (weights[j] > 0)
+            weights[j][bad] = 0
+            nout += np.sum(bad)
+        if nout == 0:
+            break
+
+    C = np.linalg.inv(A.toarray())
+    #- wavelengths without data carry no sky, and no variance
+    C[empty, :] = 0
+    C[:, empty] = 0
+    skyvar = np.diag(C)
+    skyivar = np.zeros(nwave)
+    ok = ~empty & (skyvar > 0)
+    skyivar[ok] = 1/skyvar[ok]
+    skyflux[empty] = 0
+    mask = (skyivar == 0).astype(np.int32)
+
+    #- R[w, j] R[w, k] is only non-zero for |j - k| < ndiag
+    ndiag = frame.resolution_data.shape[1]
+    covar = np.zeros((ndiag, nwave))
+    for k in range(ndiag):
+        covar[k, :nwave-k] = np.diagonal(C, k)
+    return skyflux, skyivar, mask, covar
+
+def write_compact_sky(filename, wave, skyflux, skyivar, mask, covar=None, header=None):
+    '''Writes a compact sky model (one spectrum, its ivar and mask, the wavelength grid and, if given,
+    the band of its covariance from fit_compact_sky()) to filename'''
+    fitsio.write(filename, skyflux.astype(np.float32), extname='SKY', header=header, clobber=True)
+    fitsio.write(filename, skyivar.astype(np.float32), extname='IVAR')
+    fitsio.write(filename, mask.astype(np.int32), extname='MASK')
+    fitsio.write(filename, wave, extname='WAVELENGTH')
+    if covar is not None:
+        #- float64: off-diagonal terms nearly cancel the diagonal ones in R C R^T
+        fitsio.write(filename, covar, extname='COVAR')
+
+def read_compact_sky(filename):
+    '''Returns dict with wave, skyflux, skyivar, mask and covar (None if not stored) of a compact sky model 
+    written by write_compact_sky()'''
+    with fitsio.FITS(filename) as fx:
+        covar = fx['COVAR'].read() if 'COVAR' in fx else None
+        return dict(skyflux=fx['SKY'].read().astype(float), skyivar=fx['IVAR'].read().astype(float),
+                    mask=fx['MASK'].read(), wave=fx['WAVELENGTH'].read(), covar=covar)
+
+#- cache of stacked resolution matrices, shared by the models of a camera
+_resolution_cache = OrderedDict()
+_resolution_lock = threading.Lock()
+RESOLUTION_CACHE_SIZE = 4
+
+def _get_stacked_resolution(frame, cache_key=None):
+    '''Returns Rstack, the resolution matrices of all fibers stacked into one (nspec*nwave, nwave) sparse matrix'''
+    if cache_key is not None:
+        with _resolution_lock:
+            if cache_key in _resolution_cache:
+                _resolution_cache.move_to_end(cache_key)
+                return _resolution_cache[cache_key]
+
+    Rstack = scipy.sparse.vstack([scipy.sparse.csr_matrix(Ri) for Ri in frame.R], format='csr')
+
+    if cache_key is not None:
+        with _resolution_lock:
+            _resolution_cache[cache_key] = Rstack
+            while len(_resolution_cache) > RESOLUTION_CACHE_SIZE:
+                _resolution_cache.popitem(last=False)
+    return Rstack
+
+def get_convolved_variance(Rstack, covar, nfiber_block=20):
+    '''Returns diag(R C R^T) for the stacked resolution matrices R of all fibers, see _get_stacked_resolution(),
+    and the covariance C given by its band covar (see fit_compact_sky()). Fibers are processed in blocks of
+    nfiber_block to bound memory.'''
+    nband, nwave = covar.shape
+    offsets = list(range(nband)) + list(range(-1, -nband, -1))
+    bands = [covar[k, :nwave-k] for k in range(nband)] + [covar[k, :nwave-k] for k in range(1, nband)]
+    C = scipy.sparse.diags(bands, offsets, shape=(nwave, nwave), format='csr')
+
+    var = np.zeros(Rstack.shape[0])
+    for start in range(0, Rstack.shape[0], nfiber_block*nwave):
+        Rblock = Rstack[start:start+nfiber_block*nwave]
+        var[start:start+Rblock.shape[0]] = np.asarray(Rblock.dot(C).multiply(Rblock).sum(axis=1)).ravel()
+    return var
+
+def expand_sky(compact, frame, cache_key=None):
+    '''Rebuilds the per-fiber sky model of frame from a compact sky model.
+    Args:
+        compact: dict as returned by read_compact_sky()
+        frame: desispec Frame whose resolution matrices are used
+    Options:
+        cache_key: hashable identifying the resolution data of frame, e.g. (night, expid, camera);
+            models sharing the key reuse the same stacked resolution matrices
+    Returns desispec.sky.SkyModel with the sky convolved with the resolution of each fiber. The variance of
+    each fiber is diag(R C R^T) from the covariance band of the compact model; models written without it
+    fall back to R^2 diag(C), which ignores the (negative) correlations of neighboring wavelengths of the
+    deconvolved spectrum and overestimates the variance by orders of magnitude.'''
+    from desispec.sky import SkyModel
+
+    nspec, nwave = frame.flux.shape
+    Rstack = _get_stacked_resolution(frame, cache_key=cache_key)
+
+    flux = Rstack.dot(compact['skyflux']).reshape(nspec, nwave)
+    if compact.get('covar') is not None:
+        var = get_convolved_variance(Rstack, compact['covar']).reshape(nspec, nwave)
+    else:
+        skyvar = np.zeros(nwave)
+        ok = compact['skyivar'] > 0
+        skyvar[ok] = 1/compact['skyivar'][ok]
+        var = Rstack.multiply(Rstack).dot(skyvar).reshape(nspec, nwave)
+    ivar = np.zeros((nspec, nwave))
+    ivar[var > 0] = 1/var[var > 0]
+    #- a pixel is masked if any masked sky pixel contributes to it
+    mask = (abs(Rstack).dot((compact['mask'] > 0).astype(float)).reshape(nspec, nwave) > 0).astype(np.uint32)
+    ivar[mask > 0] = 0
+    return SkyModel(frame.wave.copy(), flux, ivar, mask)
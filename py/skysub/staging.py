@@ -0,0 +1,161 @@
+"""
+Staging of input products to node-local scratch space, and bulk flush of outputs
+"""
+
+import os, shutil, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+#- shared filesystem path -> staged local copy
+_staged = dict()
+#- shared filesystem path -> number of runs using its staged copy, e.g. a fiberflat shared by two exposures
+#- processed concurrently by skysub watch
+_refs = dict()
+_lock = threading.Lock()
+
+def staged_path(path):
+    '''Returns the local copy of path if it was staged with stage_inputs(), otherwise path itself'''
+    return _staged.get(path, path)
+
+def _acquire(path, local):
+    with _lock:
+        _staged[path] = local
+        _refs[path] = _refs.get(path, 0) + 1
+
+def unstage(paths=None, remove=False):
+    '''Releases the staged files in paths, as returned by stage_files() or stage_inputs() (default all staged files).
+    A file staged by several runs is only forgotten once every run released it, then it resolves to the
+    shared filesystem again and, with remove, its local copy is deleted along with the directories left empty.'''
+    with _lock:
+        release_all = paths is None
+        if release_all:
+            paths = list(_staged)
+        for path in paths:
+            if path not in _refs:
+                continue
+            _refs[path] -= 1
+            if _refs[path] > 0 and not release_all:
+                continue
+            del _refs[path]
+            local = _staged.pop(path)
+            if remove and os.path.isfile(local):
+                os.remove(local)
+                #- remove the empty mirrored directories, up to scratchdir/inputs
+                dirname = os.path.dirname(local)
+                while os.path.basename(dirname) != 'inputs' and len(os.listdir(dirname)) == 0:
+                    os.rmdir(dirname)
+                    dirname = os.path.dirname(dirname)
+
+def get_input_list(night, expid, cameras):
+    '''Returns the list of shared filesystem frame, fiberflat and sky files used by skysub for the given
+    exposure and cameras'''
+    import fitsio
+    import desispec.io
+    from desispec.calibfinder import findcalibfile
+
+    files = []
+    for cam in cameras:
+        framefile = desispec.io.findfile('frame', night, expid, camera=cam)
+        header = fitsio.read_header(framefile)
+        files.append(framefile)
+        files.append(findcalibfile([header,], 'FIBERFLAT'))
+        files.append(desispec.io.findfile('sky', night, expid, camera=cam))
+    #- cameras can share a fiberflat, keep the order but drop duplicates
+    return list(dict.fromkeys(files))
+
+def _copy(src, dst):
+    dirname = os.path.dirname(dst)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    #- copy and rename, so that a failed copy leaves no partial file and concurrent copies of the same file
+    #- (e.g. by two runs staging a shared fiberflat) do not write into each other
+    tmpfile = '{}.{}.tmp'.format(dst, threading.get_ident())
+    try:
+        shutil.copy2(src, tmpfile)
+        os.replace(tmpfile, dst)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return os.path.getsize(dst)
+
+def stage_files(files, scratchdir, nproc=8):
+    '''Copies files to scratchdir, mirroring their absolute paths under scratchdir/inputs, and registers
+    the copies so that staged_path() resolves to them, until they are released with unstage(). Files already
+    staged are not copied again, but are registered for this call too. Copies run in nproc threads to hide
+    per-file latency of the shared filesystem, and are registered as they complete; if one fails, the files
+    registered by this call are released and removed before the error is raised.
+    Returns the number of bytes copied.'''
+    todo = []
+    acquired = []
+    for path in files:
+        local = os.path.join(scratchdir, 'inputs', os.path.abspath(path).lstrip('/'))
+        with _lock:
+            staged = _staged.get(path) == local and os.path.isfile(local)
+            if staged:
+                _refs[path] += 1
+        if staged:
+            acquired.append(path)
+        else:
+            todo.append((path, local))
+
+    nbytes = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        futures = dict((pool.submit(_copy, src, dst), (src, dst)) for src, dst in todo)
+        for future in as_completed(futures):
+            path, local = futures[future]
+            try:
+                nbytes += future.result()
+            except Exception as err:
+                error = err
+                continue
+            _acquire(path, local)
+            acquired.append(path)
+    if error is not None:
+        unstage(acquired, remove=True)
+        raise error
+
+    print('staged {} files ({:.1f} MB) to {}'.format(len(todo), nbytes/1e6, scratchdir))
+    return nbytes
+
+def stage_inputs(night, expid, cameras, scratchdir, nproc=8):
+    '''Copies the frame, fiberflat and sky files needed for the given exposure and cameras to node-local
+    scratchdir (e.g. $TMPDIR or /dev/shm) before a run, see stage_files().
+    Returns the list of staged shared filesystem paths, to release them with unstage() after the run;
+    nothing is left staged if it raises.'''
+    files = get_input_list(night, expid, cameras)
+    stage_files(files, scratchdir, nproc=nproc)
+    return files
+
+def fetch_outputs(destdir, localdir, names, nproc=8):
+    '''Copies the files names of an earlier run from destdir to localdir, e.g. to reuse them with skip_existing.
+    Modification times are preserved, so that flush_outputs() does not copy unchanged files back.
+    Returns the number of bytes copied.'''
+    todo = [(os.path.join(destdir, name), os.path.join(localdir, name)) for name in names]
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        nbytes = sum(pool.map(lambda x: _copy(*x), todo))
+    print('fetched {} files ({:.1f} MB) from {}'.format(len(todo), nbytes/1e6, destdir))
+    return nbytes
+
+def flush_outputs(localdir, destdir, nproc=8):
+    '''Copies all files written in localdir, except lock files, to destdir in one bulk step. Files already in
+    destdir with the same size and modification time are skipped. Returns the number of files copied.'''
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir, exist_ok=True)
+
+    existing = dict()
+    for entry in os.scandir(destdir):
+        if entry.is_file():
+            st = entry.stat()
+            existing[entry.name] = (st.st_size, int(st.st_mtime))
+    todo = []
+    for entry in os.scandir(localdir):
+        #- lock files of the hdf5 containers only serialize access within this run, see skysub.storage
+        if entry.is_file() and not entry.name.endswith('.lock'):
+            st = entry.stat()
+            if existing.get(entry.name) != (st.st_size, int(st.st_mtime)):
+                todo.append((entry.path, os.path.join(destdir, entry.name)))
+
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        nbytes = sum(pool.map(lambda x: _copy(*x), todo))
+    print('flushed {} files ({:.1f} MB) to {}'.format(len(todo), nbytes/1e6, destdir))
+    return len(todo)
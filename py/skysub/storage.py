@@ -0,0 +1,198 @@
+"""
+Storage backends for the generated frame, sky and sframe products
+
+'fits' (default) writes one FITS file per product, frame-{camera}-{expid}-{nsky}-{rep}.fits etc.
+'hdf5' writes all the products of an exposure into one products-{expid}.h5 container, with one group
+per product; product paths then look like {basedir}/products-{expid}.h5#{kind}/{camera}/{nsky}/{rep}.
+The read/write functions here accept both kinds of paths, so callers do not depend on the backend.
+"""
+
+import os, json, fcntl
+from contextlib import contextmanager
+import numpy as np
+
+STORAGE_TYPES = ('fits', 'hdf5')
+
+def get_container_filename(basedir, expid):
+    '''Returns the filename of the hdf5 container of all the products of an exposure'''
+    return basedir+'/products-{:08d}.h5'.format(expid)
+
+def get_product_path(kind, camera, expid, nsky, rep, basedir, storage='fits'):
+    '''Returns the path of a generated product; kind is 'frame', 'sky', 'csky' or 'sframe' and storage
+    is 'fits' or 'hdf5' (see module docstring)'''
+    if storage == 'fits':
+        return basedir+'/{}-{}-{:08d}-{}-{}.fits'.format(kind, camera, expid, nsky, rep)
+    elif storage == 'hdf5':
+        return get_container_filename(basedir, expid) + '#{}/{}/{}/{}'.format(kind, camera, nsky, rep)
+    raise ValueError('unknown storage {}, should be one of {}'.format(storage, STORAGE_TYPES))
+
+def split_path(path):
+    '''Returns (container filename, group) for a product path in an hdf5 container, (path, None) otherwise'''
+    filename, sep, group = path.partition('#')
+    if sep == '' or not filename.endswith('.h5'):
+        return path, None
+    return filename, group
+
+@contextmanager
+def _open_container(filename, mode):
+    '''Opens an hdf5 container holding a lock, exclusive for writing and shared for reading, so that
+    threads and processes can append products to the same container while others read it'''
+    import h5py
+
+    with open(filename + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+        try:
+            with h5py.File(filename, mode) as fx:
+                yield fx
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def _write_group(path, arrays, attrs=None):
+    filename, group = split_path(path)
+    with _open_container(filename, 'a') as fx:
+        g = fx.require_group(group)
+        #- hdf5 does not reclaim the space of deleted datasets, so rewritten products (retries, reruns)
+        #- are overwritten in place, and datasets are only recreated if their shape or type changed
+        for key in list(g.keys()):
+            if key not in arrays:
+                del g[key]
+        for key, value in arrays.items():
+            value = np.asarray(value)
+            if key in g:
+                if g[key].shape == value.shape and g[key].dtype == value.dtype:
+                    g[key][...] = value
+                    continue
+                del g[key]
+            #- one chunk per fiber, so that subsets of fibers can be read without the whole product
+            chunks = (1,) + value.shape[1:] if value.ndim > 1 else None
+            g.create_dataset(key, data=value, chunks=chunks)
+        attrs = attrs or dict()
+        for key in list(g.attrs.keys()):
+            if key not in attrs:
+                del g.attrs[key]
+        for key, value in attrs.items():
+            g.attrs.modify(key, value)
+
+def _read_group(path):
+    filename, group = split_path(path)
+    with _open_container(filename, 'r') as fx:
+        g = fx[group]
+        arrays = dict((key, g[key][()]) for key in g.keys())
+        attrs = dict(g.attrs.items())
+    return arrays, attrs
+
+def _fibermap_to_array(fibermap):
+    from astropy.table import Table
+
+    #- hdf5 has no unicode arrays, store strings as bytes
+    array = np.asarray(Table(fibermap).as_array())
+    dtype = [(name, 'S{}'.format(array.dtype[name].itemsize//4) if array.dtype[name].kind == 'U' else array.dtype[name])
+             for name in array.dtype.names]
+    return array.astype(dtype)
+
+def _array_to_fibermap(array):
+    from astropy.table import Table
+
+    fibermap = Table(array)
+    for name in fibermap.colnames:
+        if fibermap[name].dtype.kind == 'S':
+            fibermap[name] = np.char.decode(fibermap[name], 'ascii')
+    return fibermap
+
+def write_frame(path, frame):
+    '''Writes a desispec Frame to a product path'''
+    filename, group = split_path(path)
+    if group is None:
+        import desispec.io
+        desispec.io.write_frame(path, frame)
+        return
+    meta = dict() if frame.meta is None else dict((key, frame.meta[key]) for key in frame.meta.keys())
+    _write_group(path, dict(wave=frame.wave, flux=frame.flux, ivar=frame.ivar, mask=frame.mask,
+                            resolution=frame.resolution_data, fibermap=_fibermap_to_array(frame.fibermap)),
+                 attrs=dict(meta=json.dumps(meta, default=str)))
+
+def read_frame(path):
+    '''Reads a desispec Frame from a product path'''
+    from desispec.frame import Frame
+
+    filename, group = split_path(path)
+    if group is None:
+        import desispec.io
+        return desispec.io.read_frame(path)
+    arrays, attrs = _read_group(path)
+    return Frame(arrays['wave'], arrays['flux'], arrays['ivar'], mask=arrays['mask'],
+                 resolution_data=arrays['resolution'], fibermap=_array_to_fibermap(arrays['fibermap']),
+                 meta=json.loads(attrs['meta']))
+
+def write_sky(path, sky):
+    '''Writes a desispec SkyModel to a product path'''
+    filename, group = split_path(path)
+    if group is None:
+        import desispec.io
+        desispec.io.write_sky(path, sky)
+        return
+    _write_group(path, dict(wave=sky.wave, flux=sky.flux, ivar=sky.ivar, mask=sky.mask))
+
+def read_sky(path):
+    '''Reads a desispec SkyModel from a product path'''
+    from desispec.sky import SkyModel
+
+    filename, group = split_path(path)
+    if group is None:
+        import desispec.io
+        return desispec.io.read_sky(path)
+    arrays, attrs = _read_group(path)
+    return SkyModel(arrays['wave'], arrays['flux'], arrays['ivar'], arrays['mask'])
+
+def write_compact_sky(path, wave, skyflux, skyivar, mask, covar=None):
+    '''Writes a compact sky model to a product path, see skysub.skymodel'''
+    from . import skymodel
+
+    filename, group = split_path(path)
+    if group is None:
+        skymodel.write_compact_sky(path, wave, skyflux, skyivar, mask, covar=covar)
+        return
+    arrays = dict(wave=wave, skyflux=skyflux.astype(np.float32), skyivar=skyivar.astype(np.float32),
+                  mask=mask.astype(np.int32))
+    if covar is not None:
+        arrays['covar'] = covar
+    _write_group(path, arrays)
+
+def read_compact_sky(path):
+    '''Reads a compact sky model from a product path, see skysub.skymodel.read_compact_sky()'''
+    from . import skymodel
+
+    filename, group = split_path(path)
+    if group is None:
+        return skymodel.read_compact_sky(path)
+    arrays, attrs = _read_group(path)
+    for key in ('skyflux', 'skyivar'):
+        arrays[key] = arrays[key].astype(float)
+    arrays.setdefault('covar', None)
+    return arrays
+
+def list_products(basedir, expid, storage='fits'):
+    '''Returns the set of paths of all existing products of an exposure in basedir, from a single listing
+    of basedir (fits) or of the container (hdf5). Callers check for products in this set instead of a stat
+    per product, which is slow on shared filesystems.'''
+    products = set()
+    if storage == 'fits':
+        if not os.path.isdir(basedir):
+            return products
+        suffix = '-{:08d}'.format(expid)
+        for entry in os.scandir(basedir):
+            if entry.name.endswith('.fits') and suffix in entry.name:
+                products.add(basedir + '/' + entry.name)
+    elif storage == 'hdf5':
+        filename = get_container_filename(basedir, expid)
+        if not os.path.isfile(filename):
+            return products
+        with _open_container(filename, 'r') as fx:
+            for kind in fx.keys():
+                for cam in fx[kind].keys():
+                    for nsky in fx[kind][cam].keys():
+                        for rep in fx[kind][cam][nsky].keys():
+                            products.add(filename + '#{}/{}/{}/{}'.format(kind, cam, nsky, rep))
+    else:
+        raise ValueError('unknown storage {}, should be one of {}'.format(storage, STORAGE_TYPES))
+    return products
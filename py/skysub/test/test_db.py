@@ -0,0 +1,74 @@
+"""
+Tests of the results database of skysub.db
+"""
+
+import os, json
+import numpy as np
+from skysub import db
+
+def _data(offset=0., quick=False):
+    '''{camera: {nsky: {rep: fiber_dict}}} with mean rms offset + nsky + rep for each realization'''
+    data = dict()
+    for cam in ('b0', 'r0'):
+        data[cam] = dict()
+        for nsky in (10, 20):
+            data[cam][str(nsky)] = dict()
+            for rep in range(3):
+                rms = offset + nsky + rep + np.array([-1., 0., 1.])
+                fiber_dict = dict(fiber_RMS=list(rms), integrated_flux=[1., 2., 3.], fiber=[5, 6, 7])
+                if quick:
+                    fiber_dict['quick'] = True
+                data[cam][str(nsky)][str(rep)] = fiber_dict
+    return data
+
+def _write_json(dirname, night, expid, data):
+    filename = os.path.join(str(dirname), 'data-{}-{:08d}.json'.format(night, expid))
+    with open(filename, 'w') as fx:
+        json.dump(data, fx)
+    return filename
+
+def test_ingest_json_skips_unchanged_files(tmp_path):
+    dbfile = str(tmp_path / 'results.db')
+    filename = _write_json(tmp_path, 20200315, 1234, _data())
+    assert db.ingest_json(dbfile, filename)
+    assert not db.ingest_json(dbfile, filename)
+    assert db.ingest_json(dbfile, filename, force=True)
+
+    #- re-ingesting replaces the results of the exposure instead of adding to them
+    fibers = db.query_fibers(dbfile)
+    assert len(fibers['rms']) == 2*2*3*3
+    assert set(fibers['fiber']) == set([5, 6, 7])
+    real = db.query_realizations(dbfile, camera='b0', nsky=20)
+    assert sorted(real['rep']) == [0, 1, 2]
+    assert np.allclose(sorted(real['mean_rms']), [20., 21., 22.])
+    assert np.all(real['night'] == 20200315) and np.all(real['expid'] == 1234)
+
+def test_query_rms_vs_nsky(tmp_path):
+    dbfile = str(tmp_path / 'results.db')
+    db.ingest_json(dbfile, _write_json(tmp_path, 20200315, 1, _data()))
+    db.ingest_json(dbfile, _write_json(tmp_path, 20200316, 2, _data(offset=2.)))
+
+    curve = db.query_rms_vs_nsky(dbfile, camera='b0')
+    assert list(curve['nsky']) == [10, 20]
+    assert list(curve['nreal']) == [6, 6]
+    #- mean rms of the realizations of nsky=10: 10, 11, 12 and 12, 13, 14
+    expected = np.array([10., 11., 12., 12., 13., 14.])
+    assert np.allclose(curve['mean'][0], expected.mean())
+    assert np.allclose(curve['std'][0], expected.std())
+
+    curve = db.query_rms_vs_nsky(dbfile, camera=['b0', 'r0'], night=20200316)
+    assert list(curve['nreal']) == [6, 6]
+    assert np.allclose(curve['mean'], [13., 23.])
+
+def test_query_rms_vs_nsky_separates_quick_results(tmp_path):
+    dbfile = str(tmp_path / 'results.db')
+    db.ingest_json(dbfile, _write_json(tmp_path, 20200315, 1, _data()))
+    db.ingest_json(dbfile, _write_json(tmp_path, 20200315, 2, _data(offset=100., quick=True)))
+
+    assert np.allclose(db.query_rms_vs_nsky(dbfile, camera='b0')['mean'], [11., 21.])
+    assert np.allclose(db.query_rms_vs_nsky(dbfile, camera='b0', quick=True)['mean'], [111., 121.])
+    assert list(db.query_rms_vs_nsky(dbfile, camera='b0', quick=None)['nreal']) == [6, 6]
+
+def test_query_empty_database(tmp_path):
+    curve = db.query_rms_vs_nsky(str(tmp_path / 'results.db'))
+    assert len(curve['nsky']) == 0 and len(curve['mean']) == 0
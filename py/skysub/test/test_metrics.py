@@ -0,0 +1,28 @@
+"""
+Tests of the run metrics of skysub.metrics
+"""
+
+import os, sys, time, subprocess
+import pytest
+from skysub import metrics
+
+pytestmark = pytest.mark.skipif(not os.path.isfile('/proc/self/io'), reason='no /proc/self/io')
+
+def test_io_counters_include_subprocesses(tmp_path):
+    '''Writes of a running subprocess are counted, and counted once after it terminated'''
+    filename = str(tmp_path / 'out')
+    code = 'import os, time\nwith open({!r}, "wb") as fx:\n    fx.write(os.urandom(1<<22))\ntime.sleep(2)'.format(filename)
+    nread0, nwritten0 = metrics.get_io_counters()
+    proc = subprocess.Popen([sys.executable, '-c', code])
+    try:
+        for i in range(40):
+            if os.path.isfile(filename) and os.path.getsize(filename) == 1<<22:
+                break
+            time.sleep(0.1)
+        assert proc.pid in metrics.get_descendants()
+        running = metrics.get_io_counters()[1] - nwritten0
+        assert running >= 1<<22
+    finally:
+        proc.wait()
+    done = metrics.get_io_counters()[1] - nwritten0
+    assert 1<<22 <= done < 2*(1<<22)
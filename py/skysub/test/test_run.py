@@ -0,0 +1,174 @@
+"""
+Tests of the analysis tasks and statistics of skysub.run
+"""
+
+import types
+import numpy as np
+import pytest
+
+pytest.importorskip('desispec')
+pytest.importorskip('bokeh')
+from skysub import run
+from skysub.scheduler import run_tasks
+
+NSPEC = 40
+
+def _fake_inputs(monkeypatch, candidates):
+    '''Replaces the pipeline inputs by frames with only a fibermap, and the per-arm fiber cuts by candidates
+    {arm: boolean array}; returns the dict {camera: {(nsky, rep): OBJTYPE}} the frames are written to'''
+    written = dict()
+    def read_inputs(night, expid, camera):
+        #- a structured array, so that column assignments broadcast as in a fibermap Table
+        frame = types.SimpleNamespace(camera=camera, fibermap=np.zeros(NSPEC, dtype=[('OBJTYPE', 'U3')]))
+        return frame, None
+    def write_frame(path, frame):
+        cam, expid, nsky, rep = path.split('/')[-1][:-len('.fits')].split('-')[1:]
+        written.setdefault(cam, dict())[(int(nsky), int(rep))] = frame.fibermap['OBJTYPE'].copy()
+    monkeypatch.setattr(run, 'read_inputs', read_inputs)
+    monkeypatch.setattr(run, 'get_sky_candidates', lambda frame, fiberflat: candidates[frame.camera[0]])
+    monkeypatch.setattr(run.products, 'write_frame', write_frame)
+    return written
+
+def test_petal_frames_share_sky_fibers(monkeypatch, tmp_path):
+    '''The arms of a model get the same sky fibers, among the fibers passing the cuts of every arm'''
+    rng = np.random.default_rng(0)
+    candidates = dict((arm, rng.random(NSPEC) > 0.2) for arm in 'brz')
+    eligible = candidates['b'] & candidates['r'] & candidates['z']
+    written = _fake_inputs(monkeypatch, candidates)
+    cameras, nsky_list, reps = ['b3', 'r3', 'z3'], [2, 5], 3
+
+    tasks = run.get_analysis_tasks(20200315, 1234, cameras, str(tmp_path), nsky_list, reps=reps, by_petal=True)
+    frame_tasks = [task for task in tasks if task.stage in ('select', 'frame')]
+    assert run_tasks(frame_tasks, nproc=4)['done'] == len(frame_tasks)
+
+    for n in nsky_list:
+        for N in range(reps):
+            objtypes = [written[cam][(n, N)] for cam in cameras]
+            for objtype in objtypes[1:]:
+                assert np.array_equal(objtype, objtypes[0])
+            assert np.sum(objtypes[0] == 'SKY') == n
+            assert np.array_equal(objtypes[0] == 'BAD', ~eligible)
+            assert np.all(eligible[objtypes[0] == 'SKY'])
+
+def test_petal_sky_tasks_only_wait_for_their_frames(monkeypatch, tmp_path):
+    _fake_inputs(monkeypatch, dict((arm, np.ones(NSPEC, dtype=bool)) for arm in 'brz'))
+    tasks = run.get_analysis_tasks(20200315, 1234, ['b3', 'r3', 'z3', 'b4'], str(tmp_path), [2, 5], reps=2, by_petal=True)
+    assert sorted(task.name for task in tasks if task.stage == 'select') == ['select-petal3', 'select-petal4']
+    for task in tasks:
+        if task.stage == 'sky':
+            cam, n, N = task.cell
+            assert [dep.name for dep in task.deps] == ['frame-petal{}-{}-{}'.format(cam[1:], n, N)]
+            assert [dep.name for dep in task.deps[0].deps] == ['select-petal{}'.format(cam[1:])]
+
+def test_failed_attach_detaches_attached_cameras(monkeypatch, tmp_path):
+    '''If a camera fails to attach to its shared store, the cameras attached before are detached'''
+    detached = []
+    def attach(night, expid, camera):
+        if camera == 'z3':
+            raise IOError('missing sky file')
+    monkeypatch.setattr(run, 'get_analysis_tasks', lambda *args, **kwargs: [])
+    monkeypatch.setattr(run.shm, 'attach', attach)
+    monkeypatch.setattr(run.shm, 'detach', lambda night, expid, camera: detached.append(camera))
+    with pytest.raises(IOError):
+        run.run_analysis(20200315, 1234, ['b3', 'r3', 'z3', 'b4'], str(tmp_path), [2,], shared=True)
+    assert detached == ['b3', 'r3']
+
+def _fake_sframe(monkeypatch, seed=0):
+    rng = np.random.default_rng(seed)
+    nwave = 200
+    fibermap = np.zeros(NSPEC, dtype=[('OBJTYPE', 'U3'), ('FIBER', int)])
+    fibermap['OBJTYPE'] = 'TGT'
+    fibermap['OBJTYPE'][:10] = 'SKY'
+    fibermap['OBJTYPE'][10:12] = 'BAD'
+    fibermap['FIBER'] = np.arange(NSPEC) + 500
+    ivar = rng.random((NSPEC, nwave)) + 0.5
+    ivar[rng.random((NSPEC, nwave)) < 0.1] = 0
+    #- a band of wavelengths masked in every fiber, its bin is empty
+    ivar[:, 100:110] = 0
+    frame = types.SimpleNamespace(wave=np.linspace(5000., 5199., nwave), flux=rng.normal(size=(NSPEC, nwave)),
+                                  ivar=ivar, fibermap=fibermap)
+    monkeypatch.setattr(run.products, 'read_frame', lambda path: frame)
+    return frame
+
+def test_cell_stats_residuals_match_brute_force(monkeypatch):
+    frame = _fake_sframe(monkeypatch)
+    wave_bins = np.arange(4980., 5230., 10.)
+    wave_filter = frame.wave > 5050.
+    fiber_dict, residuals = run.get_cell_stats('sframe.fits', wave_filter, wave_bins=wave_bins)
+
+    tgt = np.where(frame.fibermap['OBJTYPE'] == 'TGT')[0]
+    assert fiber_dict['fiber'] == list(frame.fibermap['FIBER'][tgt])
+    assert np.allclose(fiber_dict['fiber_RMS'], np.sqrt(np.mean(frame.flux[tgt][:, wave_filter]**2, axis=1)))
+    assert np.allclose(fiber_dict['integrated_flux'], np.sum(frame.flux[tgt][:, wave_filter], axis=1))
+    assert 'quick' not in fiber_dict
+
+    for b in range(len(wave_bins) - 1):
+        values, chi2 = [], []
+        for i in tgt:
+            for j in range(len(frame.wave)):
+                if wave_bins[b] <= frame.wave[j] < wave_bins[b+1] and frame.ivar[i, j] > 0:
+                    values.append(frame.flux[i, j])
+                    chi2.append(frame.flux[i, j]**2*frame.ivar[i, j])
+        assert residuals['npix'][b] == len(values)
+        if len(values) == 0:
+            assert np.isnan(residuals['mean'][b]) and np.isnan(residuals['rms'][b]) and np.isnan(residuals['chi2'][b])
+        else:
+            assert np.isclose(residuals['mean'][b], np.mean(values))
+            assert np.isclose(residuals['rms'][b], np.sqrt(np.mean(np.square(values))))
+            assert np.isclose(residuals['chi2'][b], np.mean(chi2))
+    #- bins outside of the wavelength range and the fully masked band
+    assert residuals['npix'][0] == 0 and residuals['npix'][-1] == 0
+    assert residuals['npix'][np.searchsorted(wave_bins, 5105.) - 1] == 0
+
+def test_save_residual_cube(monkeypatch, tmp_path):
+    _fake_sframe(monkeypatch)
+    wave_bins = np.arange(4980., 5230., 10.)
+    nsky_list, reps = [2, 5, 10], 3
+    residuals = dict(b3=dict(), r3=dict())
+    for n, N in [(2, 0), (2, 2), (10, 1)]:
+        residuals['b3'][(n, N)] = run.get_cell_stats('sframe.fits', np.ones(200, dtype=bool), wave_bins=wave_bins)[1]
+    residuals['r3'][(5, 0)] = residuals['b3'][(2, 0)]
+
+    filename = run.save_residual_cube(20200315, 1234, residuals, nsky_list, reps, str(tmp_path), wave_bins=wave_bins)
+    with np.load(filename) as cube:
+        assert np.array_equal(cube['wave_bins'], wave_bins)
+        assert list(cube['nsky_list']) == nsky_list
+        for cam in ('b3', 'r3'):
+            for key in ('mean', 'rms', 'chi2', 'npix'):
+                array = cube['{}_{}'.format(cam, key)]
+                assert array.shape == (len(nsky_list), reps, len(wave_bins) - 1)
+                for i, n in enumerate(nsky_list):
+                    for N in range(reps):
+                        if (n, N) in residuals[cam]:
+                            assert np.allclose(array[i, N], residuals[cam][(n, N)][key], equal_nan=True)
+                        else:
+                            assert np.all(np.isnan(array[i, N]))
+
+def test_quick_grid():
+    nsky_list = [1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80]
+    grid = run.get_quick_grid(nsky_list, nsky=4)
+    assert grid == [1, 10, 50, 80]
+    #- unsorted input with duplicates, and grids as large as the list
+    assert run.get_quick_grid([80, 1, 5, 5, 1], nsky=4) == [1, 5, 80]
+    assert run.get_quick_grid([5, 1, 80, 20], nsky=4) == [1, 5, 20, 80]
+    for nsky in range(2, 12):
+        grid = run.get_quick_grid(nsky_list, nsky=nsky)
+        assert grid[0] == 1 and grid[-1] == 80
+        assert len(grid) == len(set(grid)) and len(grid) <= nsky
+        assert grid == sorted(grid)
+
+def test_bootstrap_rms_curve():
+    rng = np.random.default_rng(0)
+    cam_data = {'10': dict((str(N), dict(fiber_RMS=list(rng.normal(5., 1., size=50)))) for N in range(4)),
+                20: {0: dict(fiber_RMS=[2., 2., 2.]), 1: dict(fiber_RMS=[2., 2.])},
+                30: {0: dict(fiber_RMS=[])}}
+    curve = run.bootstrap_rms_curve(cam_data, [10, 20, 30, 40], nboot=200)
+    assert curve['nsky'] == [10, 20, 30, 40]
+    assert curve['nreal'] == [4, 2, 0, 0]
+    means = [np.mean(d['fiber_RMS']) for d in cam_data['10'].values()]
+    assert np.isclose(curve['mean'][0], np.mean(means))
+    assert curve['lo'][0] < curve['mean'][0] < curve['hi'][0]
+    assert curve['mean'][1] == curve['lo'][1] == curve['hi'][1] == 2.
+    #- no realizations, or only realizations without fibers
+    for i in (2, 3):
+        assert np.isnan(curve['mean'][i]) and np.isnan(curve['lo'][i]) and np.isnan(curve['hi'][i])
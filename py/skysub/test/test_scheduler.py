@@ -0,0 +1,113 @@
+"""
+Tests of the task scheduler of skysub.scheduler
+"""
+
+import time, threading
+from skysub.scheduler import Task, run_tasks
+
+class Recorder(object):
+    '''Task functions that record their start order and the number of tasks running concurrently'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = set()
+        #- name -> largest number of other tasks running at some point while it ran
+        self.overlap = dict()
+        self.calls = dict()
+
+    def func(self, name, seconds=0.05, fail=0, oom=0):
+        '''Returns a function that sleeps seconds, after raising RuntimeError on its first fail calls
+        and MemoryError on its next oom calls'''
+        def run():
+            with self.lock:
+                self.started.append(name)
+                self.calls[name] = self.calls.get(name, 0) + 1
+                ncalls = self.calls[name]
+                self.running.add(name)
+            try:
+                if ncalls <= fail:
+                    raise RuntimeError('{} failed'.format(name))
+                if ncalls <= fail + oom:
+                    raise MemoryError('{} ran out of memory'.format(name))
+                end = time.time() + seconds
+                while time.time() < end:
+                    with self.lock:
+                        self.overlap[name] = max(self.overlap.get(name, 0), len(self.running) - 1)
+                    time.sleep(0.005)
+                return name
+            finally:
+                with self.lock:
+                    self.running.discard(name)
+        return run
+
+def test_dependencies_run_in_order():
+    rec = Recorder()
+    frame = Task('frame', rec.func('frame'))
+    sky = Task('sky', rec.func('sky'), deps=[frame,])
+    sframe = Task('sframe', rec.func('sframe'), deps=[frame, sky])
+    summary = run_tasks([sframe, sky, frame], nproc=3)
+    assert summary == dict(done=3, failed=0, skipped=0)
+    assert rec.started == ['frame', 'sky', 'sframe']
+    assert sframe.result == 'sframe'
+
+def test_retries():
+    rec = Recorder()
+    flaky = Task('flaky', rec.func('flaky', fail=2))
+    assert run_tasks([flaky,], retries=2) == dict(done=1, failed=0, skipped=0)
+    assert flaky.attempts == 3
+
+    rec = Recorder()
+    flaky = Task('flaky', rec.func('flaky', fail=2))
+    assert run_tasks([flaky,], retries=1) == dict(done=0, failed=1, skipped=0)
+    assert flaky.attempts == 2
+    assert 'RuntimeError' in flaky.error
+
+def test_descendants_of_failed_task_are_skipped():
+    rec = Recorder()
+    frame = Task('frame', rec.func('frame', fail=1))
+    sky = Task('sky', rec.func('sky'), deps=[frame,])
+    sframe = Task('sframe', rec.func('sframe'), deps=[sky,])
+    other = Task('other', rec.func('other'))
+    summary = run_tasks([frame, sky, sframe, other], nproc=2)
+    assert summary == dict(done=1, failed=1, skipped=2)
+    assert (frame.state, sky.state, sframe.state, other.state) == ('failed', 'skipped', 'skipped', 'done')
+    assert 'sky' not in rec.started and 'sframe' not in rec.started
+
+def test_memory_admission_is_in_order():
+    '''A ready task that does not fit in memory blocks the smaller tasks after it instead of being starved'''
+    rec = Recorder()
+    big1 = Task('big1', rec.func('big1', seconds=0.2), memory=6)
+    big2 = Task('big2', rec.func('big2', seconds=0.1), memory=6)
+    small = Task('small', rec.func('small'), memory=1)
+    summary = run_tasks([big1, big2, small], nproc=3, max_memory=10)
+    assert summary == dict(done=3, failed=0, skipped=0)
+    assert rec.started == ['big1', 'big2', 'small']
+    assert rec.overlap['big1'] == 0
+
+def test_task_larger_than_budget_runs_alone():
+    rec = Recorder()
+    huge = Task('huge', rec.func('huge'), memory=100)
+    small = Task('small', rec.func('small'), memory=1)
+    assert run_tasks([huge, small], nproc=2, max_memory=10) == dict(done=2, failed=0, skipped=0)
+    assert rec.overlap['huge'] == 0
+
+def test_out_of_memory_task_is_rescheduled_alone():
+    rec = Recorder()
+    tasks = [Task('sky', rec.func('sky', seconds=0.1, oom=1))]
+    tasks += [Task('frame{}'.format(i), rec.func('frame{}'.format(i), seconds=0.1)) for i in range(4)]
+    summary = run_tasks(tasks, nproc=3, retries=0, oom_retries=1)
+    assert summary == dict(done=5, failed=0, skipped=0)
+    assert rec.calls['sky'] == 2
+    #- the rescheduled run did not share the machine, and did not use up a retry
+    assert rec.overlap['sky'] == 0
+    assert tasks[0].attempts == 1
+
+def test_out_of_memory_retries_are_bounded():
+    rec = Recorder()
+    sky = Task('sky', rec.func('sky', oom=5))
+    sframe = Task('sframe', rec.func('sframe'), deps=[sky,])
+    summary = run_tasks([sky, sframe], oom_retries=2)
+    assert summary == dict(done=0, failed=1, skipped=1)
+    assert rec.calls['sky'] == 3
+    assert 'MemoryError' in sky.error
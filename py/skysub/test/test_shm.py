@@ -0,0 +1,90 @@
+"""
+Tests of the node-local shared store of skysub.shm, in a temporary directory instead of /dev/shm
+"""
+
+import os, json, subprocess
+import numpy as np
+import pytest
+from skysub import shm
+
+NIGHT, EXPID = 20200315, 1234
+
+@pytest.fixture
+def populate(monkeypatch):
+    '''Replaces the reading of the pipeline products by two small arrays, and counts the calls'''
+    calls = []
+    def _populate(storedir, night, expid, camera):
+        calls.append(camera)
+        shm._save(storedir, 'wave', np.linspace(3600., 5900., 10))
+        shm._save(storedir, 'flux', np.ones((5, 10)))
+        open(os.path.join(storedir, 'READY'), 'w').close()
+    monkeypatch.setattr(shm, '_populate', _populate)
+    monkeypatch.setattr(shm, '_attached', dict())
+    return calls
+
+def _refs(storedir):
+    with open(os.path.join(storedir, 'refs.json')) as fx:
+        return json.load(fx)
+
+def _dead_pid():
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+def test_attach_and_last_detach_removes_store(tmp_path, populate):
+    storedir = shm.attach(NIGHT, EXPID, 'b0', shmdir=str(tmp_path))
+    assert shm.is_attached(NIGHT, EXPID, 'b0')
+    assert _refs(storedir) == [os.getpid(),]
+    #- attaching again from the same process is a no-op
+    assert shm.attach(NIGHT, EXPID, 'b0', shmdir=str(tmp_path)) == storedir
+    assert populate == ['b0',] and _refs(storedir) == [os.getpid(),]
+
+    arrays = shm.get_arrays(NIGHT, EXPID, 'b0')
+    assert np.array_equal(arrays['flux'], np.ones((5, 10)))
+    assert isinstance(arrays['flux'], np.memmap) and not arrays['flux'].flags.writeable
+
+    shm.detach(NIGHT, EXPID, 'b0')
+    assert not shm.is_attached(NIGHT, EXPID, 'b0')
+    assert not os.path.exists(storedir)
+    #- detaching a store that is not attached is a no-op
+    shm.detach(NIGHT, EXPID, 'b0')
+
+def test_store_is_shared_and_kept_while_referenced(tmp_path, populate):
+    '''A store loaded by another live process is reused, and kept when this process detaches'''
+    other = os.getppid()
+    storedir = shm.attach(NIGHT, EXPID, 'r0', shmdir=str(tmp_path))
+    shm._write_refs(storedir, [other,])
+    shm._attached.clear()
+
+    assert shm.attach(NIGHT, EXPID, 'r0', shmdir=str(tmp_path)) == storedir
+    assert populate == ['r0',]
+    assert _refs(storedir) == [other, os.getpid()]
+    shm.detach(NIGHT, EXPID, 'r0')
+    assert os.path.isdir(storedir) and _refs(storedir) == [other,]
+
+def test_stale_pids_are_pruned(tmp_path, populate):
+    '''Processes that exited without detaching do not keep a store alive'''
+    storedir = shm.attach(NIGHT, EXPID, 'z0', shmdir=str(tmp_path))
+    shm._write_refs(storedir, [_dead_pid(), os.getpid()])
+    shm.detach(NIGHT, EXPID, 'z0')
+    assert not os.path.exists(storedir)
+
+def test_incomplete_store_is_reloaded(tmp_path, populate):
+    storedir = os.path.join(str(tmp_path), shm._key(NIGHT, EXPID, 'b1'))
+    os.makedirs(storedir)
+    open(os.path.join(storedir, 'flux.npy'), 'w').close()
+    shm.attach(NIGHT, EXPID, 'b1', shmdir=str(tmp_path))
+    assert populate == ['b1',]
+    assert np.array_equal(shm.get_arrays(NIGHT, EXPID, 'b1')['flux'], np.ones((5, 10)))
+    shm.detach(NIGHT, EXPID, 'b1')
+
+def test_failed_load_leaves_no_store(tmp_path, monkeypatch):
+    def _populate(storedir, night, expid, camera):
+        shm._save(storedir, 'wave', np.ones(10))
+        raise IOError('missing sky file')
+    monkeypatch.setattr(shm, '_populate', _populate)
+    monkeypatch.setattr(shm, '_attached', dict())
+    with pytest.raises(IOError):
+        shm.attach(NIGHT, EXPID, 'b2', shmdir=str(tmp_path))
+    assert not shm.is_attached(NIGHT, EXPID, 'b2')
+    assert not os.path.exists(os.path.join(str(tmp_path), shm._key(NIGHT, EXPID, 'b2')))
@@ -0,0 +1,93 @@
+"""
+Tests of the compact sky models of skysub.skymodel
+"""
+
+import types
+import numpy as np
+import scipy.sparse
+import pytest
+from skysub import skymodel
+
+NSPEC, NSKY, NWAVE, HALFWIDTH = 30, 20, 200, 5
+
+def _resolution_data(nspec, nwave, halfwidth, vary=True, seed=0):
+    '''Gaussian resolution kernels, data[i, k] is the diagonal of offset halfwidth-k'''
+    rng = np.random.default_rng(seed)
+    data = np.zeros((nspec, 2*halfwidth+1, nwave))
+    for i in range(nspec):
+        sigma = 1. + (0.3*rng.random() if vary else 0.)
+        kernel = np.exp(-0.5*(np.arange(-halfwidth, halfwidth+1)/sigma)**2)
+        data[i] = (kernel/kernel.sum())[:, None]
+    return data
+
+def _resolution_matrix(data):
+    halfwidth = data.shape[0] // 2
+    nwave = data.shape[1]
+    offsets = list(range(halfwidth, -halfwidth-1, -1))
+    return scipy.sparse.diags([data[k, 0]*np.ones(nwave - abs(o)) for k, o in enumerate(offsets)], offsets, format='csr')
+
+def _simple_frame(seed=0):
+    rng = np.random.default_rng(seed)
+    resolution_data = _resolution_data(NSPEC, NWAVE, HALFWIDTH, seed=seed)
+    R = [_resolution_matrix(d) for d in resolution_data]
+    sky = 100 + 50*np.sin(np.arange(NWAVE)/7.)
+    flux = np.array([Ri.dot(sky) for Ri in R]) + rng.normal(size=(NSPEC, NWAVE))
+    objtype = np.array(['SKY']*NSKY + ['TGT']*(NSPEC-NSKY))
+    return types.SimpleNamespace(flux=flux, ivar=np.ones((NSPEC, NWAVE)), mask=np.zeros((NSPEC, NWAVE), dtype=int),
+                                 R=R, resolution_data=resolution_data, fibermap=dict(OBJTYPE=objtype),
+                                 wave=np.linspace(5000., 6000., NWAVE))
+
+def test_convolved_variance_is_exact():
+    '''The variance rebuilt from the covariance band is diag(R C R^T) of each fiber'''
+    frame = _simple_frame()
+    #- no outlier rejection, so that C is the inverse of the normal matrix of all sky fibers
+    skyflux, skyivar, mask, covar = skymodel.fit_compact_sky(frame, nsig_clipping=1e6)
+    A = sum(Ri.T.dot(Ri).toarray() for Ri in frame.R[:NSKY])
+    C = np.linalg.inv(A)
+    exact = np.array([np.diag(Ri.dot(C).dot(Ri.T.toarray())) for Ri in frame.R])
+
+    Rstack = skymodel._get_stacked_resolution(frame)
+    var = skymodel.get_convolved_variance(Rstack, covar, nfiber_block=7).reshape(NSPEC, NWAVE)
+    assert np.allclose(var, exact, rtol=1e-8)
+    assert np.allclose(1/skyivar, np.diag(C), rtol=1e-8)
+
+def test_compact_sky_file_roundtrip(tmp_path):
+    frame = _simple_frame()
+    skyflux, skyivar, mask, covar = skymodel.fit_compact_sky(frame)
+    filename = str(tmp_path / 'csky.fits')
+    skymodel.write_compact_sky(filename, frame.wave, skyflux, skyivar, mask, covar=covar)
+    compact = skymodel.read_compact_sky(filename)
+    assert np.allclose(compact['skyflux'], skyflux, rtol=1e-6)
+    assert np.array_equal(compact['covar'], covar)
+
+def test_compact_and_full_sky_ivar_agree():
+    '''Compact and desi_compute_sky --no-extra-variance (full) sky models give the same sframe ivar.
+    All fibers share one resolution, so that any approximation by the mean resolution in desispec is exact.'''
+    pytest.importorskip('desispec')
+    from astropy.table import Table
+    from desispec.frame import Frame
+    from desispec.sky import compute_sky, subtract_sky
+    from copy import deepcopy
+
+    rng = np.random.default_rng(1)
+    wave = np.linspace(5000., 6000., NWAVE)
+    resolution_data = _resolution_data(NSPEC, NWAVE, HALFWIDTH, vary=False)
+    R = _resolution_matrix(resolution_data[0])
+    sky = 100 + 50*np.sin(np.arange(NWAVE)/7.)
+    flux = np.tile(R.dot(sky), (NSPEC, 1)) + rng.normal(size=(NSPEC, NWAVE))
+    fibermap = Table(dict(FIBER=np.arange(NSPEC), OBJTYPE=np.array(['SKY']*NSKY + ['TGT']*(NSPEC-NSKY)),
+                          FIBERSTATUS=np.zeros(NSPEC, dtype=int)))
+    frame = Frame(wave, flux, np.ones((NSPEC, NWAVE)), mask=np.zeros((NSPEC, NWAVE), dtype=np.uint32),
+                  resolution_data=resolution_data, fibermap=fibermap, meta=dict(CAMERA='b0'))
+
+    full = compute_sky(deepcopy(frame), add_variance=False)
+    skyflux, skyivar, mask, covar = skymodel.fit_compact_sky(deepcopy(frame))
+    compact = skymodel.expand_sky(dict(skyflux=skyflux, skyivar=skyivar, mask=mask, covar=covar), frame)
+
+    tgt = slice(NSKY, NSPEC)
+    inner = slice(2*HALFWIDTH, NWAVE-2*HALFWIDTH)
+    assert np.allclose(compact.ivar[tgt, inner], full.ivar[tgt, inner], rtol=1e-3)
+    sframes = [deepcopy(frame), deepcopy(frame)]
+    subtract_sky(sframes[0], full)
+    subtract_sky(sframes[1], compact)
+    assert np.allclose(sframes[1].ivar[tgt, inner], sframes[0].ivar[tgt, inner], rtol=1e-3)
@@ -0,0 +1,104 @@
+"""
+Tests of the staging of inputs and the flush of outputs of skysub.staging, on temporary directories
+"""
+
+import os
+import pytest
+from skysub import staging
+
+def _write(filename, content, mtime=None):
+    with open(filename, 'w') as fx:
+        fx.write(content)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+def test_flush_outputs_copies_new_and_changed_files(tmp_path):
+    localdir, destdir = tmp_path / 'local', str(tmp_path / 'dest')
+    localdir.mkdir()
+    _write(str(localdir / 'frame-b0-00001234-10-0.fits'), 'frame', mtime=1e9)
+    _write(str(localdir / 'sframe-b0-00001234-10-0.fits'), 'sframe', mtime=1e9)
+    os.mkdir(str(localdir / 'subdir'))
+
+    assert staging.flush_outputs(str(localdir), destdir) == 2
+    assert sorted(os.listdir(destdir)) == ['frame-b0-00001234-10-0.fits', 'sframe-b0-00001234-10-0.fits']
+    assert os.path.getmtime(os.path.join(destdir, 'frame-b0-00001234-10-0.fits')) == 1e9
+
+    #- unchanged files are not copied again, rewritten ones are
+    assert staging.flush_outputs(str(localdir), destdir) == 0
+    _write(str(localdir / 'sframe-b0-00001234-10-0.fits'), 'sframe2', mtime=1e9 + 10)
+    assert staging.flush_outputs(str(localdir), destdir) == 1
+    with open(os.path.join(destdir, 'sframe-b0-00001234-10-0.fits')) as fx:
+        assert fx.read() == 'sframe2'
+
+def test_fetched_outputs_are_not_flushed_back(tmp_path):
+    localdir, destdir = str(tmp_path / 'local'), tmp_path / 'dest'
+    destdir.mkdir()
+    os.mkdir(localdir)
+    _write(str(destdir / 'frame-b0-00001234-10-0.fits'), 'frame', mtime=1e9)
+    staging.fetch_outputs(str(destdir), localdir, ['frame-b0-00001234-10-0.fits'])
+    assert os.listdir(localdir) == ['frame-b0-00001234-10-0.fits']
+    assert staging.flush_outputs(localdir, str(destdir)) == 0
+
+def test_stage_and_unstage_files(tmp_path):
+    shared = tmp_path / 'shared' / 'exposures'
+    shared.mkdir(parents=True)
+    files = [str(shared / 'frame-b0.fits'), str(shared / 'sky-b0.fits')]
+    for filename in files:
+        _write(filename, 'input')
+    scratchdir = str(tmp_path / 'scratch')
+
+    assert staging.stage_files(files, scratchdir) == 2*len('input')
+    local = staging.staged_path(files[0])
+    assert local.startswith(os.path.join(scratchdir, 'inputs')) and os.path.isfile(local)
+    #- already staged files are not copied again, but each call holds a reference to them
+    assert staging.stage_files(files, scratchdir) == 0
+    staging.unstage(files, remove=True)
+    assert staging.staged_path(files[0]) == local and os.path.isfile(local)
+
+    staging.unstage(files, remove=True)
+    assert staging.staged_path(files[0]) == files[0]
+    assert not os.path.exists(local)
+    #- the mirrored directories are removed up to scratchdir/inputs
+    assert os.listdir(os.path.join(scratchdir, 'inputs')) == []
+
+def test_shared_staged_file_outlives_first_release(tmp_path):
+    '''A file staged by two runs, e.g. a fiberflat shared by two exposures, stays staged until both released it'''
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    fiberflat, frame1, frame2 = [str(shared / name) for name in ('fiberflat.fits', 'frame1.fits', 'frame2.fits')]
+    for filename in (fiberflat, frame1, frame2):
+        _write(filename, 'input')
+    scratchdir = str(tmp_path / 'scratch')
+
+    run1, run2 = [fiberflat, frame1], [fiberflat, frame2]
+    staging.stage_files(run1, scratchdir)
+    assert staging.stage_files(run2, scratchdir) == len('input')
+    local = staging.staged_path(fiberflat)
+
+    staging.unstage(run1, remove=True)
+    assert staging.staged_path(fiberflat) == local and os.path.isfile(local)
+    assert staging.staged_path(frame1) == frame1
+    staging.unstage(run2, remove=True)
+    assert staging.staged_path(fiberflat) == fiberflat and not os.path.exists(local)
+
+def test_failed_staging_leaves_nothing_staged(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    files = [str(shared / 'frame.fits'), str(shared / 'missing.fits'), str(shared / 'sky.fits')]
+    _write(files[0], 'input')
+    _write(files[2], 'input')
+    scratchdir = str(tmp_path / 'scratch')
+
+    with pytest.raises(OSError):
+        staging.stage_files(files, scratchdir, nproc=1)
+    for filename in files:
+        assert staging.staged_path(filename) == filename
+    assert os.listdir(os.path.join(scratchdir, 'inputs')) == []
+
+def test_flush_outputs_skips_lock_files(tmp_path):
+    localdir, destdir = tmp_path / 'local', str(tmp_path / 'dest')
+    localdir.mkdir()
+    _write(str(localdir / 'products-00001234.h5'), 'container')
+    _write(str(localdir / 'products-00001234.h5.lock'), '')
+    assert staging.flush_outputs(str(localdir), destdir) == 1
+    assert os.listdir(destdir) == ['products-00001234.h5']
@@ -0,0 +1,34 @@
+"""
+Tests of the hdf5 container backend of skysub.storage
+"""
+
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('h5py')
+from skysub import storage
+
+def test_rewritten_product_does_not_grow_container(tmp_path):
+    '''Rewriting a product overwrites its datasets in place instead of leaking the space of the old ones'''
+    path = storage.get_product_path('csky', 'b0', 1234, 10, 0, str(tmp_path), storage='hdf5')
+    filename, group = storage.split_path(path)
+    arrays = dict(skyflux=np.ones((500, 2000)), mask=np.zeros(2000, dtype=np.int32))
+    storage._write_group(path, arrays, attrs=dict(meta='{}'))
+    size = os.path.getsize(filename)
+    for i in range(5):
+        arrays['skyflux'] = arrays['skyflux'] + 1
+        storage._write_group(path, arrays, attrs=dict(meta='{}'))
+    assert os.path.getsize(filename) == size
+
+    read, attrs = storage._read_group(path)
+    assert np.array_equal(read['skyflux'], arrays['skyflux'])
+    assert attrs['meta'] == '{}'
+
+def test_rewritten_product_drops_stale_datasets(tmp_path):
+    path = storage.get_product_path('csky', 'b0', 1234, 10, 0, str(tmp_path), storage='hdf5')
+    storage._write_group(path, dict(skyflux=np.ones(10), covar=np.ones((3, 10))))
+    storage._write_group(path, dict(skyflux=np.zeros(20)))
+    read, attrs = storage._read_group(path)
+    assert sorted(read) == ['skyflux']
+    assert np.array_equal(read['skyflux'], np.zeros(20))
@@ -0,0 +1,92 @@
+"""
+Tests of the exposure watcher of skysub.watch, on a temporary redux tree
+"""
+
+import os, json, time
+import pytest
+from skysub import watch
+
+NIGHT = 20200315
+
+def _write_inputs(reduxdir, expid, cameras, mtime=None, kinds=('frame', 'sky')):
+    expdir = os.path.join(watch.get_exposures_dir(NIGHT, reduxdir=reduxdir), '{:08d}'.format(expid))
+    os.makedirs(expdir, exist_ok=True)
+    for cam in cameras:
+        for kind in kinds:
+            filename = os.path.join(expdir, '{}-{}-{:08d}.fits'.format(kind, cam, expid))
+            open(filename, 'w').close()
+            if mtime is not None:
+                os.utime(filename, (mtime, mtime))
+
+@pytest.fixture
+def fake_process(monkeypatch):
+    '''Replaces the analysis of an exposure by publishing a data json with its cameras'''
+    calls = []
+    def process_exposure(night, expid, cameras, basedir, jsondir, nsky_list, outdir=None, dbfile=None, **kwargs):
+        calls.append((expid, sorted(cameras), kwargs.get('skip_existing', False)))
+        with open(jsondir + '/data-{}-{:08d}.json'.format(night, expid), 'w') as fx:
+            json.dump(dict((cam, {}) for cam in cameras), fx)
+        return 'plot-{:08d}.html'.format(expid)
+    monkeypatch.setattr(watch, 'process_exposure', process_exposure)
+    return calls
+
+def test_find_ready_exposures_waits_for_sky_and_settle(tmp_path):
+    reduxdir = str(tmp_path)
+    old = time.time() - 600
+    _write_inputs(reduxdir, 1, ['b0', 'r0'], mtime=old)
+    #- frame without sky model yet: not ready
+    _write_inputs(reduxdir, 2, ['b0'], mtime=old, kinds=('frame',))
+    #- just written: not settled
+    _write_inputs(reduxdir, 3, ['b0'])
+
+    ready = watch.find_ready_exposures(NIGHT, settle=60., reduxdir=reduxdir)
+    assert sorted(ready) == [1]
+    assert ready[1][0] == ['b0', 'r0']
+    assert watch.find_ready_exposures(NIGHT, cameras=['b0', 'z0'], settle=60., reduxdir=reduxdir) == dict()
+
+def test_find_ready_exposures_waits_for_unfinished_camera(tmp_path):
+    '''A camera with a frame but no sky model holds back the whole exposure'''
+    reduxdir = str(tmp_path)
+    old = time.time() - 600
+    _write_inputs(reduxdir, 1, ['b0'], mtime=old)
+    _write_inputs(reduxdir, 1, ['r0'], mtime=old, kinds=('frame',))
+    assert watch.find_ready_exposures(NIGHT, settle=60., reduxdir=reduxdir) == dict()
+
+def test_watch_once_processes_ready_exposures(tmp_path, fake_process):
+    reduxdir, jsondir = str(tmp_path / 'redux'), str(tmp_path / 'json')
+    os.makedirs(jsondir)
+    old = time.time() - 600
+    _write_inputs(reduxdir, 1, ['b0', 'r0'], mtime=old)
+    _write_inputs(reduxdir, 2, ['b1'])
+
+    results = watch.watch([NIGHT,], str(tmp_path / 'out'), jsondir, [1, 2], reduxdir=reduxdir, settle=60., once=True)
+    assert results == {(NIGHT, 1): 'plot-00000001.html'}
+    assert fake_process == [(1, ['b0', 'r0'], False)]
+
+    #- published exposures are not processed again by a restarted watch
+    results = watch.watch([NIGHT,], str(tmp_path / 'out'), jsondir, [1, 2], reduxdir=reduxdir, settle=60., once=True)
+    assert results == dict()
+    assert len(fake_process) == 1
+
+def test_watch_requeues_exposure_with_late_cameras(tmp_path, fake_process):
+    '''Cameras finished by the pipeline after an exposure was published are analyzed too'''
+    reduxdir, jsondir = str(tmp_path / 'redux'), str(tmp_path / 'json')
+    os.makedirs(jsondir)
+    old = time.time() - 600
+    _write_inputs(reduxdir, 1, ['b0'], mtime=old)
+    watch.watch([NIGHT,], str(tmp_path / 'out'), jsondir, [1, 2], reduxdir=reduxdir, settle=60., once=True)
+
+    _write_inputs(reduxdir, 1, ['r0', 'z0'], mtime=old + 10)
+    results = watch.watch([NIGHT,], str(tmp_path / 'out'), jsondir, [1, 2], reduxdir=reduxdir, settle=60., once=True)
+    assert results == {(NIGHT, 1): 'plot-00000001.html'}
+    assert fake_process == [(1, ['b0'], False), (1, ['b0', 'r0', 'z0'], True)]
+    assert watch.get_processed_cameras(NIGHT, 1, jsondir) == set(['b0', 'r0', 'z0'])
+
+def test_watch_explicit_cameras_waits_for_all(tmp_path, fake_process):
+    reduxdir, jsondir = str(tmp_path / 'redux'), str(tmp_path / 'json')
+    os.makedirs(jsondir)
+    _write_inputs(reduxdir, 1, ['b0'], mtime=time.time() - 600)
+    results = watch.watch([NIGHT,], str(tmp_path / 'out'), jsondir, [1, 2], cameras=['b0', 'r0'], reduxdir=reduxdir,
+                          settle=60., once=True)
+    assert results == dict()
+    assert fake_process == []
@@ -0,0 +1,171 @@
+"""
+Interactive Bokeh server to browse frame and sframe spectra, loading them on demand
+"""
+
+import os, re
+from functools import lru_cache, partial
+import numpy as np
+from . import storage
+import bokeh.plotting as bk
+from bokeh.layouts import row, column
+from bokeh.models import ColumnDataSource, Select, RangeSlider
+from bokeh.events import RangesUpdate
+
+PRODUCT_REGEX = re.compile(r'(frame|sframe)-([brz]\d)-(\d{8})-(\d+)-(\d+)\.fits$')
+CONTAINER_REGEX = re.compile(r'products-(\d{8})\.h5$')
+
+def get_product_index(basedir):
+    '''Returns dict {(kind, camera, expid, nsky, rep): path} of the frame and sframe products in basedir,
+    including those in the hdf5 containers in it (see skysub.storage)'''
+    basedir = os.path.expandvars(basedir)
+    index = dict()
+    for entry in os.scandir(basedir):
+        m = PRODUCT_REGEX.match(entry.name)
+        if m is not None:
+            kind, cam, expid, nsky, rep = m.groups()
+            index[(kind, cam, int(expid), int(nsky), int(rep))] = entry.path
+        m = CONTAINER_REGEX.match(entry.name)
+        if m is not None:
+            for path in storage.list_products(basedir, int(m.group(1)), storage='hdf5'):
+                kind, cam, nsky, rep = storage.split_path(path)[1].split('/')
+                if kind in ('frame', 'sframe'):
+                    index[(kind, cam, int(m.group(1)), int(nsky), int(rep))] = path
+    return index
+
+@lru_cache(maxsize=32)
+def load_spectra(filename):
+    '''Returns (wave, flux) of the target fibers of a frame file or container product as float32 arrays; 
+    decoded products are kept in a least-recently-used cache so that switching back to a model does not re-read it'''
+    frame = storage.read_frame(filename)
+    tgt = np.where(frame.fibermap['OBJTYPE'] == 'TGT')[0]
+    return frame.wave.astype(np.float32), frame.flux[tgt].astype(np.float32)
+
+def decimate(wave, flux, wmin, wmax, npix):
+    '''Returns (xs, ys) lists for multi_line of the spectra flux[fiber, wave] within [wmin, wmax], reduced to
+    at most about npix points per spectrum. Each block of pixels is replaced by its min and max, so that
+    narrow sky line residuals stay visible.'''
+    ii = np.where((wmin <= wave) & (wave <= wmax))[0]
+    if len(ii) == 0:
+        return [], []
+    wave = wave[ii[0]:ii[-1]+1]
+    flux = flux[:, ii[0]:ii[-1]+1]
+    step = int(np.ceil(2*len(wave)/npix))
+    if step <= 1:
+        return [wave]*len(flux), list(flux)
+
+    nblocks = len(wave) // step
+    wave = wave[:nblocks*step].reshape(nblocks, step).mean(axis=1)
+    flux = flux[:, :nblocks*step].reshape(len(flux), nblocks, step)
+    x = np.repeat(wave, 2)
+    y = np.empty((len(flux), 2*nblocks), dtype=np.float32)
+    y[:, 0::2] = flux.min(axis=2)
+    y[:, 1::2] = flux.max(axis=2)
+    return [x]*len(flux), list(y)
+
+def make_document(doc, basedir, index=None, npix=1000, width=600, height=400):
+    '''Builds the viewer: selectors for exposure, camera, nsky and realization, a slider for the range of
+    target fibers, and frame (unsubtracted) and sframe (subtracted) plots. Spectra are only loaded for the
+    selected model and only the decimated pixels of the visible wavelength range are sent to the browser.
+    index is the product index of basedir from get_product_index(), scanned here if not given.'''
+    if index is None:
+        index = get_product_index(basedir)
+    if len(index) == 0:
+        raise ValueError('no frame or sframe files in {}'.format(basedir))
+
+    def options(pos, **selected):
+        values = set()
+        for key in index:
+            if all(key[i] == value for i, value in selected.items()):
+                values.add(key[pos])
+        return [str(v) for v in sorted(values)]
+
+    expid_select = Select(title='Exposure', options=options(2))
+    expid_select.value = expid_select.options[0]
+    cam_select = Select(title='Camera', options=options(1, **{2: int(expid_select.value)}))
+    cam_select.value = cam_select.options[0]
+    nsky_select = Select(title='Sky fibers', options=[])
+    rep_select = Select(title='Realization', options=[])
+    fiber_slider = RangeSlider(title='Target fibers', start=0, end=1, value=(0, 1), step=1)
+
+    sources = dict()
+    figs = dict()
+    for kind, title in (('frame', 'Frame'), ('sframe', 'S-Frame')):
+        sources[kind] = ColumnDataSource(data=dict(xs=[], ys=[]))
+        figs[kind] = bk.figure(width=width, height=height, title=title, output_backend='webgl')
+        figs[kind].multi_line('xs', 'ys', source=sources[kind], alpha=0.5)
+        figs[kind].xaxis.axis_label = 'Wavelength [A]'
+    figs['sframe'].x_range = figs['frame'].x_range
+
+    def selected_model():
+        if nsky_select.value is None or rep_select.value is None or nsky_select.value == '' or rep_select.value == '':
+            return None
+        return (cam_select.value, int(expid_select.value), int(nsky_select.value), int(rep_select.value))
+
+    #- visible wavelength range, None until the user zooms or pans
+    view = dict(wmin=None, wmax=None)
+
+    def update_plots():
+        wmin, wmax = view['wmin'], view['wmax']
+        model = selected_model()
+        for kind in sources:
+            filename = None if model is None else index.get((kind,) + model)
+            if filename is None:
+                sources[kind].data = dict(xs=[], ys=[])
+                continue
+            wave, flux = load_spectra(filename)
+            lo, hi = fiber_slider.value
+            xs, ys = decimate(wave, flux[int(lo):int(hi)+1],
+                              wave[0] if wmin is None else wmin, wave[-1] if wmax is None else wmax, npix)
+            sources[kind].data = dict(xs=xs, ys=ys)
+
+    def update_fibers():
+        model = selected_model()
+        filename = None if model is None else index.get(('sframe',) + model, index.get(('frame',) + model))
+        if filename is not None:
+            nfiber = load_spectra(filename)[1].shape[0]
+            fiber_slider.end = max(nfiber-1, 1)
+            fiber_slider.value = (0, min(49, nfiber-1))
+        update_plots()
+
+    def update_models(attr=None, old=None, new=None):
+        cam_select.options = options(1, **{2: int(expid_select.value)})
+        if cam_select.value not in cam_select.options:
+            cam_select.value = cam_select.options[0]
+        selected = {1: cam_select.value, 2: int(expid_select.value)}
+        nsky_select.options = sorted(options(3, **selected), key=int)
+        if nsky_select.value not in nsky_select.options:
+            nsky_select.value = nsky_select.options[0]
+        rep_select.options = sorted(options(4, **selected), key=int)
+        if rep_select.value not in rep_select.options:
+            rep_select.value = rep_select.options[0]
+        update_fibers()
+
+    def on_range(event):
+        view['wmin'], view['wmax'] = event.x0, event.x1
+        update_plots()
+
+    update_models()
+    for widget in (expid_select, cam_select):
+        widget.on_change('value', update_models)
+    for widget in (nsky_select, rep_select):
+        widget.on_change('value', lambda attr, old, new: update_fibers())
+    fiber_slider.on_change('value_throttled', lambda attr, old, new: update_plots())
+    for fig in figs.values():
+        fig.on_event(RangesUpdate, on_range)
+
+    controls = column(expid_select, cam_select, nsky_select, rep_select, fiber_slider)
+    doc.add_root(row(controls, figs['frame'], figs['sframe']))
+    doc.title = 'skysub'
+
+def serve(basedir, port=5006, npix=1000):
+    '''Starts the viewer for the products in basedir on http://localhost:port, only accepting local connections'''
+    from bokeh.server.server import Server
+
+    #- the index is shared by all browser sessions
+    index = get_product_index(basedir)
+    print('found {} frame and sframe files in {}'.format(len(index), basedir))
+    server = Server({'/': partial(make_document, basedir=basedir, index=index, npix=npix)}, address='localhost', port=port,
+                    allow_websocket_origin=['localhost:{}'.format(port)])
+    server.start()
+    print('serving {} on http://localhost:{}/'.format(basedir, port))
+    server.io_loop.start()
@@ -0,0 +1,167 @@
+"""
+Watches the redux exposures/{night} tree and runs the full analysis of each new exposure as soon as
+its pipeline products are complete
+"""
+
+import os, re, json, time, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+FRAME_REGEX = re.compile(r'frame-([brz]\d)-(\d{8})\.fits$')
+NIGHT_REGEX = re.compile(r'\d{8}$')
+
+def get_exposures_dir(night=None, reduxdir=None):
+    '''Returns the exposures directory of a night (or the top exposures directory if night is None)
+    in reduxdir, default $DESI_SPECTRO_REDUX/$SPECPROD'''
+    if reduxdir is None:
+        reduxdir = os.path.join(os.environ['DESI_SPECTRO_REDUX'], os.environ['SPECPROD'])
+    if night is None:
+        return os.path.join(reduxdir, 'exposures')
+    return os.path.join(reduxdir, 'exposures', str(night))
+
+def get_latest_night(reduxdir=None):
+    '''Returns the most recent night with an exposures directory in reduxdir, or None'''
+    expdir = get_exposures_dir(reduxdir=reduxdir)
+    if not os.path.isdir(expdir):
+        return None
+    nights = [int(entry.name) for entry in os.scandir(expdir) if entry.is_dir() and NIGHT_REGEX.match(entry.name)]
+    return max(nights) if len(nights) > 0 else None
+
+def find_ready_exposures(night, cameras=None, settle=60., reduxdir=None, now=None):
+    '''Returns dict {expid: (cameras, mtime)} of the exposures of a night whose inputs are complete: for every
+    camera (all cameras with a frame if cameras is None), the frame and the pipeline sky model exist, and no
+    input changed in the last settle seconds, so that files still being written are not picked up.
+    The pipeline only writes the sky model after the fiberflat was applied, so flats and arcs are not
+    selected. mtime is the modification time of the newest input.
+    With cameras None, an exposure is ready as soon as the cameras processed so far settled; cameras the
+    pipeline finishes later make it ready again with a larger camera set, see watch().'''
+    if now is None:
+        now = time.time()
+    nightdir = get_exposures_dir(night, reduxdir=reduxdir)
+    if not os.path.isdir(nightdir):
+        return dict()
+
+    ready = dict()
+    for expentry in os.scandir(nightdir):
+        if not (expentry.is_dir() and NIGHT_REGEX.match(expentry.name)):
+            continue
+        mtimes = dict((entry.name, entry.stat().st_mtime) for entry in os.scandir(expentry.path) if entry.is_file())
+        expid = int(expentry.name)
+        expcams = cameras
+        if expcams is None:
+            #- cameras with a frame but no sky model yet are still being processed, wait for them too
+            expcams = sorted(m.group(1) for m in map(FRAME_REGEX.match, mtimes) if m is not None)
+        names = ['{}-{}-{:08d}.fits'.format(kind, cam, expid) for cam in expcams for kind in ('frame', 'sky')]
+        if len(expcams) == 0 or not all(name in mtimes for name in names):
+            continue
+        mtime = max(mtimes[name] for name in names)
+        if now - mtime >= settle:
+            ready[expid] = (list(expcams), mtime)
+    return ready
+
+def get_processed_cameras(night, expid, jsondir):
+    '''Returns the set of cameras of an exposure whose results were already published to jsondir'''
+    filename = jsondir + '/data-{}-{:08d}.json'.format(night, expid)
+    if not os.path.isfile(filename):
+        return set()
+    with open(filename) as fx:
+        return set(json.load(fx).keys())
+
+def process_exposure(night, expid, cameras, basedir, jsondir, nsky_list, outdir=None, dbfile=None, **kwargs):
+    '''Runs the full analysis of an exposure and publishes its results: the json, curve and cube files in jsondir,
+    the results database dbfile if given, and the plots in outdir/cam_plots-{night}-{expid}.html (default jsondir).
+    The frame, sky and sframe files are written to basedir/{night}/{expid}. Other keyword arguments are
+    passed to skysub.run.full_analysis(). Returns the plot filename.'''
+    import bokeh.plotting as bk
+    from bokeh.resources import CDN
+    from . import run
+
+    if outdir is None:
+        outdir = jsondir
+    expdir = os.path.join(basedir, str(night), '{:08d}'.format(expid))
+    for dirname in (expdir, jsondir, outdir):
+        os.makedirs(dirname, exist_ok=True)
+    cam_fig = run.full_analysis(night, expid, cameras, expdir, jsondir, nsky_list, dbfile=dbfile, **kwargs)
+    filename = outdir + '/cam_plots-{}-{:08d}.html'.format(night, expid)
+    #- explicit filename instead of bk.output_file(), exposures are published from concurrent threads
+    bk.save(cam_fig, filename=filename, resources=CDN, title='skysub {} {:08d}'.format(night, expid))
+    print('wrote {}'.format(filename))
+    return filename
+
+def watch(nights, basedir, jsondir, nsky_list, cameras=None, outdir=None, dbfile=None, reduxdir=None, nworkers=1,
+          poll=30., settle=60., once=False, **kwargs):
+    '''Polls the exposures directories of nights for new exposures and processes each of them once its inputs
+    are complete, see find_ready_exposures() and process_exposure().
+    Args:
+        nights: list of nights YYYYMMDD to watch; if empty or None, the most recent night in reduxdir,
+            re-evaluated at every poll so that the watch rolls over to the next night
+        basedir: where to write the frame, sky and sframe files, in basedir/{night}/{expid}
+        jsondir: where to publish the json, curve and cube files
+        nsky_list: list of numbers of sky fibers of the models
+    Options:
+        cameras: cameras to analyze, default all cameras with a frame
+        outdir: where to publish the plots, default jsondir
+        dbfile: results database to ingest the results into, see skysub.db
+        reduxdir: redux production directory, default $DESI_SPECTRO_REDUX/$SPECPROD
+        nworkers: number of exposures processed concurrently, default 1
+        poll: seconds between two scans of the exposures directories, default 30
+        settle: seconds without changes before the inputs of an exposure are considered complete, default 60
+        once: process the exposures ready now and return instead of watching, e.g. to catch up on a night
+    Exposures already published to jsondir with all their cameras are skipped, so a restarted watch only
+    processes new exposures. When a camera of a published exposure becomes ready later (cameras None), the
+    exposure is processed again with all its cameras, reusing the products of the cameras done before
+    (skip_existing). Exposures that failed are not retried with the same cameras until the watch is restarted.
+    Other keyword arguments are passed to skysub.run.full_analysis().
+    Returns dict {(night, expid): plot filename or None if it failed} of the last processing of each exposure.'''
+
+    results = dict()
+    running = dict()
+    #- (night, expid) -> set of cameras processed (or attempted) so far
+    processed = dict()
+
+    def process(night, expid, expcams, mtime, rerun):
+        try:
+            options = dict(kwargs)
+            if rerun:
+                options['skip_existing'] = True
+            filename = process_exposure(night, expid, expcams, basedir, jsondir, nsky_list, outdir=outdir,
+                                        dbfile=dbfile, **options)
+            print('published {} {:08d}, {:.0f} s after its last input'.format(night, expid, time.time() - mtime))
+            return filename
+        except Exception:
+            print('FAILED {} {:08d}'.format(night, expid))
+            traceback.print_exc()
+            return None
+
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        while True:
+            for key, future in list(running.items()):
+                if future.done():
+                    results[key] = future.result()
+                    del running[key]
+
+            watched = nights
+            if watched is None or len(watched) == 0:
+                latest = get_latest_night(reduxdir=reduxdir)
+                watched = [] if latest is None else [latest,]
+            for night in watched:
+                ready = find_ready_exposures(night, cameras=cameras, settle=settle, reduxdir=reduxdir)
+                for expid in sorted(ready):
+                    key = (night, expid)
+                    if key in running:
+                        continue
+                    expcams, mtime = ready[expid]
+                    if key not in processed:
+                        processed[key] = get_processed_cameras(night, expid, jsondir)
+                    if set(expcams) <= processed[key]:
+                        continue
+                    rerun = len(processed[key]) > 0
+                    print('queuing {} {:08d} cameras {}{}'.format(night, expid, ','.join(expcams),
+                                                                 ' (new cameras)' if rerun else ''))
+                    processed[key] = processed[key] | set(expcams)
+                    running[key] = pool.submit(process, night, expid, expcams, mtime, rerun)
+
+            if once:
+                for key, future in running.items():
+                    results[key] = future.result()
+                return results
+            time.sleep(poll)